@@ -0,0 +1,10 @@
+"""
+Benchmarks for the chat proxy.
+
+bench.fake_rasa is a stand-in for Rasa's REST webhook with configurable
+latency, response size and error rate, so the proxy can be measured offline.
+bench.run starts it together with main:app and drives both with simulated
+chat sessions:
+
+    python -m bench.run --sessions 2000 --turns 5 --output results.json
+"""
@@ -0,0 +1,86 @@
+"""
+A fake Rasa server: answers the REST webhook after a simulated delay.
+
+Every response item carries {"custom": {"upstream_ms": <delay>}} so the
+benchmark can tell how much of the measured latency was spent "in Rasa".
+
+    python -m bench.fake_rasa --port 5005 --latency lognormal --latency-ms 150
+"""
+import argparse
+import asyncio
+import random
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+import uvicorn
+
+
+def delay_sampler(distribution: str, latency_ms: float, spread: float):
+    """Returns a function giving a random delay in milliseconds."""
+    if distribution == "fixed":
+        return lambda: latency_ms
+    if distribution == "uniform":
+        return lambda: random.uniform(latency_ms * (1 - spread), latency_ms * (1 + spread))
+    if distribution == "lognormal":
+        # latency_ms is the median, spread the sigma of the underlying normal
+        return lambda: random.lognormvariate(0, spread) * latency_ms
+    if distribution == "exponential":
+        return lambda: random.expovariate(1 / latency_ms) if latency_ms > 0 else 0.0
+    raise ValueError(f"Unknown latency distribution: {distribution}")
+
+
+def create_app(distribution: str = "fixed", latency_ms: float = 100.0, spread: float = 0.5,
+               responses: int = 2, response_size: int = 120, error_rate: float = 0.0) -> FastAPI:
+    app = FastAPI()
+    sample_delay = delay_sampler(distribution, latency_ms, spread)
+    filler = "x" * max(response_size - 40, 0)
+
+    @app.get("/")
+    async def root():
+        return Response("Hello from Rasa: fake")
+
+    @app.post("/webhooks/rest/webhook")
+    async def webhook(request: Request):
+        body = await request.json()
+        delay = sample_delay()
+        await asyncio.sleep(delay / 1000)
+        if random.random() < error_rate:
+            return Response(status_code=500)
+        sender = body.get("sender", "default")
+        return JSONResponse([
+            {
+                "recipient_id": sender,
+                "text": f"Answer {i + 1} to: {body.get('message', '')[:40]} {filler}",
+                "custom": {"upstream_ms": delay},
+            }
+            for i in range(responses)
+        ])
+
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", default="lognormal", choices=["fixed", "uniform", "lognormal", "exponential"],
+                        help="Distribution of the simulated Rasa latency")
+    parser.add_argument("--latency-ms", type=float, default=100.0, help="Median (or fixed/mean) latency in ms")
+    parser.add_argument("--latency-spread", type=float, default=0.5,
+                        help="Sigma for lognormal, relative half-width for uniform")
+    parser.add_argument("--responses", type=int, default=2, help="Response items per turn")
+    parser.add_argument("--response-size", type=int, default=120, help="Approximate bytes of text per item")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of turns answered with a 500")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5005)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    app = create_app(args.latency, args.latency_ms, args.latency_spread,
+                     args.responses, args.response_size, args.error_rate)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""
+Drives main:app against bench.fake_rasa and reports what the proxy costs.
+
+Starts the fake Rasa server and the proxy as subprocesses, replays many
+concurrent chat sessions against /chat, then hammers the home page, and
+prints a JSON report: throughput, p50/p95/p99 latency, the part of it spent
+in (fake) Rasa vs. in the proxy, and resident memory per worker.
+
+    python -m bench.run --sessions 2000 --turns 5 --workers 2 --output results.json
+
+Everything runs on localhost, no network access is needed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+from bench.fake_rasa import add_arguments as add_fake_rasa_arguments
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def raise_file_limit():
+    # Thousands of sessions need thousands of sockets
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def percentiles(values: List[float]) -> Dict:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def at(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+
+    return {
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "p50": at(0.50),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": round(ordered[-1], 3),
+    }
+
+
+def process_tree(root_pid: int) -> List[int]:
+    """The server process and its worker processes (Linux only, empty elsewhere)."""
+    if not os.path.isdir("/proc"):
+        return []
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                cmdline = f.read()
+        except (OSError, ValueError, IndexError):
+            continue
+        if ppid == root_pid and b"resource_tracker" not in cmdline:
+            children.append(int(entry))
+    return [root_pid] + children
+
+
+def rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def memory_report(root_pid: int) -> Dict:
+    pids = process_tree(root_pid)
+    processes = {pid: rss_mb(pid) for pid in pids}
+    # With several workers the parent only supervises, the workers serve requests
+    workers = [rss for pid, rss in processes.items() if rss is not None and (pid != root_pid or len(pids) == 1)]
+    return {
+        "processes_rss_mb": {str(pid): rss for pid, rss in processes.items()},
+        "per_worker_rss_mb": round(sum(workers) / len(workers), 1) if workers else None,
+    }
+
+
+async def wait_until_up(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+async def run_session(client: httpx.AsyncClient, index: int, args, samples: List, errors: Dict):
+    sender = f"bench_{index}"
+    await asyncio.sleep(random.uniform(0, args.ramp_up))
+    for turn in range(args.turns):
+        start = time.perf_counter()
+        try:
+            response = await client.post("/chat", json={"sender": sender, "message": f"turn {turn} of {sender}"})
+            elapsed = (time.perf_counter() - start) * 1000
+            items = response.json().get("responses", [])
+        except (httpx.HTTPError, ValueError) as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            continue
+
+        upstream = next((i["custom"]["upstream_ms"] for i in items if isinstance(i.get("custom"), dict)), None)
+        if response.status_code != 200 or upstream is None:
+            key = f"status_{response.status_code}" if response.status_code != 200 else "error_message"
+            errors[key] = errors.get(key, 0) + 1
+        samples.append((elapsed, upstream))
+        if args.think_time:
+            await asyncio.sleep(random.expovariate(1 / args.think_time))
+
+
+async def bench_chat(base_url: str, args, server_pid: int) -> Dict:
+    samples: List = []
+    errors: Dict = {}
+    limits = httpx.Limits(max_connections=args.sessions, max_keepalive_connections=args.sessions)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60.0) as client:
+        start = time.perf_counter()
+        sessions = [asyncio.create_task(run_session(client, i, args, samples, errors)) for i in range(args.sessions)]
+        # Sample memory while the load is at its peak
+        await asyncio.sleep(args.ramp_up + 0.5 * args.turns * args.latency_ms / 1000)
+        memory = memory_report(server_pid)
+        await asyncio.gather(*sessions)
+        duration = time.perf_counter() - start
+
+    latencies = [elapsed for elapsed, _ in samples]
+    answered = [(elapsed, upstream) for elapsed, upstream in samples if upstream is not None]
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(samples) / duration, 1) if duration else 0.0,
+        "latency_ms": percentiles(latencies),
+        "upstream_ms": percentiles([upstream for _, upstream in answered]),
+        "overhead_ms": percentiles([elapsed - upstream for elapsed, upstream in answered]),
+        "memory": memory,
+    }
+
+
+async def bench_home(base_url: str, args) -> Dict:
+    latencies: List[float] = []
+    sizes: List[int] = []
+    queue: asyncio.Queue = asyncio.Queue()
+    for _ in range(args.page_requests):
+        queue.put_nowait(None)
+
+    async def worker(client: httpx.AsyncClient):
+        while not queue.empty():
+            queue.get_nowait()
+            start = time.perf_counter()
+            response = await client.get("/", headers={"Accept-Encoding": "br, gzip"})
+            latencies.append((time.perf_counter() - start) * 1000)
+            sizes.append(int(response.headers.get("content-length", len(response.content))))
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=30.0) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(args.page_concurrency)))
+        duration = time.perf_counter() - start
+
+    return {
+        "requests": len(latencies),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(latencies) / duration, 1) if duration else 0.0,
+        "latency_ms": percentiles(latencies),
+        "bytes_on_wire": sizes[0] if sizes else None,
+    }
+
+
+def start(command: List[str], env: Dict) -> subprocess.Popen:
+    # Server logs go to stderr so the report on stdout stays valid JSON
+    return subprocess.Popen(command, cwd=ROOT_DIR, env=env, stdout=sys.stderr)
+
+
+def stop(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def run(args) -> Dict:
+    raise_file_limit()
+    rasa_port, proxy_port = free_port(), free_port()
+    env = dict(os.environ)
+
+    fake_rasa = start([
+        sys.executable, "-m", "bench.fake_rasa", "--port", str(rasa_port),
+        "--latency", args.latency, "--latency-ms", str(args.latency_ms),
+        "--latency-spread", str(args.latency_spread), "--responses", str(args.responses),
+        "--response-size", str(args.response_size), "--error-rate", str(args.error_rate),
+    ], env)
+    proxy = start([
+        sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(proxy_port),
+        "--workers", str(args.workers), "--log-level", "warning",
+    # Every simulated session comes from 127.0.0.1, the per-IP limit would throttle them all
+    ], dict(env, RASA_SERVER_URL=f"http://127.0.0.1:{rasa_port}", RATE_LIMIT_IP_RATE="0"))
+
+    base_url = f"http://127.0.0.1:{proxy_port}"
+    try:
+        await wait_until_up(f"http://127.0.0.1:{rasa_port}/")
+        await wait_until_up(f"{base_url}/health/ready")
+        report = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "config": {k: v for k, v in vars(args).items() if k != "output"},
+            "chat": await bench_chat(base_url, args, proxy.pid),
+        }
+        if args.page_requests:
+            report["home"] = await bench_home(base_url, args)
+        return report
+    finally:
+        stop(proxy)
+        stop(fake_rasa)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=500, help="Concurrent simulated chat sessions")
+    parser.add_argument("--turns", type=int, default=5, help="Messages sent by each session")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="Seconds over which sessions start")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Mean seconds between a session's turns")
+    parser.add_argument("--workers", type=int, default=1, help="Proxy worker processes")
+    parser.add_argument("--page-requests", type=int, default=2000, help="GET / requests (0 to skip)")
+    parser.add_argument("--page-concurrency", type=int, default=50)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    add_fake_rasa_arguments(parser)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    chat = report["chat"]
+    print(
+        f"chat: {chat['throughput_rps']} req/s, p50 {chat['latency_ms'].get('p50')} ms, "
+        f"p99 {chat['latency_ms'].get('p99')} ms, proxy overhead p50 {chat['overhead_ms'].get('p50')} ms",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+// Unique session ID for the user's conversation with Rasa
+const sessionId = 'user_' + Date.now();
+
+// Directory the page was served from: "/" for the default bot, "/bots/<name>/"
+// for the others. Every API URL is relative to it so it reaches the same bot.
+const basePath = location.pathname.replace(/[^/]*$/, '');
+
+// Persistent WebSocket session; messages fall back to HTTP whenever it isn't available
+const chatSocket = {
+  ws: null,
+  nextId: 1,
+  pending: {},
+  retryAt: 0,
+  retryDelay: 1000
+};
+
+// Set while the server says Rasa is slow (X-Chat-Mode: async, or "mode":
+// "async" on the end of a streamed turn): messages then skip the WebSocket and
+// /chat/stream, submit a job and long-poll for it instead of holding a
+// connection open for the whole turn
+let useChatJobs = false;
+
+function connectSocket() {
+  if (!('WebSocket' in window) || Date.now() < chatSocket.retryAt) {
+      return;
+  }
+  if (chatSocket.ws && chatSocket.ws.readyState <= WebSocket.OPEN) {
+      return;
+  }
+
+  const scheme = location.protocol === 'https:' ? 'wss://' : 'ws://';
+  const ws = new WebSocket(scheme + location.host + basePath + 'ws?sender=' + encodeURIComponent(sessionId));
+  chatSocket.ws = ws;
+
+  ws.onopen = function() {
+    chatSocket.retryDelay = 1000;
+  };
+
+  ws.onmessage = function(event) {
+    const frame = JSON.parse(event.data);
+    if (frame.type === 'ping') {
+        ws.send(JSON.stringify({ type: 'pong' }));
+        return;
+    }
+    const turn = chatSocket.pending[frame.id];
+    if (!turn) {
+        return;
+    }
+    if (frame.type === 'response') {
+        if (frame.response && frame.response.text) {
+            addBotMessage(frame.response.text);
+            turn.shown++;
+        }
+    } else if (frame.type === 'overloaded' || frame.type === 'rate_limited') {
+        addBotMessage(frame.text);
+        turn.shown++;
+    } else if (frame.type === 'done') {
+        useChatJobs = frame.mode === 'async';
+        delete chatSocket.pending[frame.id];
+        turn.resolve(turn.shown);
+    }
+  };
+
+  ws.onclose = function(event) {
+    if (chatSocket.ws === ws) {
+        chatSocket.ws = null;
+    }
+    // An idle close is expected, anything else backs off before retrying
+    if (event.code !== 1000) {
+        chatSocket.retryAt = Date.now() + chatSocket.retryDelay;
+        chatSocket.retryDelay = Math.min(chatSocket.retryDelay * 2, 60000);
+    }
+    for (const id in chatSocket.pending) {
+        const turn = chatSocket.pending[id];
+        const error = new Error('WebSocket closed');
+        error.partial = turn.shown > 0;
+        turn.reject(error);
+    }
+    chatSocket.pending = {};
+  };
+}
+
+// Sends a message over the WebSocket and resolves with the number of
+// messages shown once the server marks the turn as done
+function sendOverSocket(message) {
+  const ws = chatSocket.ws;
+  if (!ws || ws.readyState !== WebSocket.OPEN) {
+      connectSocket();
+      return Promise.reject(new Error('WebSocket not connected'));
+  }
+  return new Promise(function(resolve, reject) {
+    const id = chatSocket.nextId++;
+    chatSocket.pending[id] = { resolve: resolve, reject: reject, shown: 0 };
+    ws.send(JSON.stringify({ type: 'message', id: id, message: message }));
+  });
+}
+
+const timeFormat = new Intl.DateTimeFormat([], { hour: '2-digit', minute: '2-digit' });
+
+function getCurrentTime() {
+  return timeFormat.format(new Date());
+}
+
+// Message markup comes from the <template>s in the page and is cloned for every message
+const botTemplate = document.getElementById('bot-message-template').content.firstElementChild;
+const userTemplate = document.getElementById('user-message-template').content.firstElementChild;
+
+function createMessage(template, content) {
+  const message = template.cloneNode(true);
+  message.querySelector('.timestamp').textContent = getCurrentTime();
+  const contentNode = message.lastElementChild;
+  if (typeof content === 'string') {
+      contentNode.textContent = content;
+  } else {
+      contentNode.appendChild(content);
+  }
+  return message;
+}
+
+// Turns **text** into <strong> elements and keeps everything else as plain text
+function formatBotText(text) {
+  const fragment = document.createDocumentFragment();
+  const parts = text.split(/\*\*(.+?)\*\*/);
+  for (let i = 0; i < parts.length; i++) {
+    if (!parts[i]) {
+        continue;
+    }
+    if (i % 2 === 1) {
+        const strong = document.createElement('strong');
+        strong.textContent = parts[i];
+        fragment.appendChild(strong);
+    } else {
+        fragment.appendChild(document.createTextNode(parts[i]));
+    }
+  }
+  return fragment;
+}
+
+// New messages are collected in a fragment and added to the page once per
+// animation frame, together with the scroll and the pruning of old messages
+const renderQueue = {
+  fragment: document.createDocumentFragment(),
+  scheduled: false,
+  forceScroll: false
+};
+
+function scheduleRender(forceScroll) {
+  renderQueue.forceScroll = renderQueue.forceScroll || forceScroll;
+  if (!renderQueue.scheduled) {
+      renderQueue.scheduled = true;
+      requestAnimationFrame(renderMessages);
+  }
+}
+
+function renderMessages() {
+  const messagesContainer = document.getElementById('chat-messages');
+  // Read before writing so the layout is only computed once per frame
+  const atBottom = messagesContainer.scrollHeight - messagesContainer.scrollTop - messagesContainer.clientHeight < 80;
+
+  messagesContainer.appendChild(renderQueue.fragment);
+  // Only drop old messages while the user isn't scrolled up reading them
+  if (atBottom || renderQueue.forceScroll) {
+      pruneMessages(messagesContainer);
+      messagesContainer.scrollTop = messagesContainer.scrollHeight;
+  }
+
+  renderQueue.scheduled = false;
+  renderQueue.forceScroll = false;
+}
+
+// Keeps at most data-max-messages messages in the page (0 keeps all of them)
+function pruneMessages(messagesContainer) {
+  const maxMessages = parseInt(messagesContainer.dataset.maxMessages || '0', 10);
+  if (!maxMessages) {
+      return;
+  }
+  let excess = messagesContainer.childElementCount - maxMessages;
+  while (excess-- > 0) {
+    messagesContainer.firstElementChild.remove();
+  }
+}
+
+// Renders a message from the bot
+function addBotMessage(content) {
+  renderQueue.fragment.appendChild(createMessage(botTemplate, formatBotText(content)));
+  scheduleRender(false);
+}
+
+// Renders a message from the user
+function addUserMessage(content) {
+  renderQueue.fragment.appendChild(createMessage(userTemplate, content));
+  scheduleRender(true);
+}
+
+function showTypingIndicator() {
+  document.getElementById('typing-indicator').classList.add('show');
+  scheduleRender(false);
+}
+
+function hideTypingIndicator() {
+  document.getElementById('typing-indicator').classList.remove('show');
+}
+
+function closePrivacyNotice() {
+  document.getElementById('privacy-notice').style.display = 'none';
+}
+
+function handleKeyPress(event) {
+  if (event.key === 'Enter') {
+    sendMessage();
+  }
+}
+
+// Called when the user clicks the send button or presses Enter
+function sendMessage() {
+  const input = document.getElementById('message-input');
+  const message = input.value.trim();
+  if (message) {
+    addUserMessage(message);
+    input.value = '';
+    sendToChatbot(message);
+  }
+}
+
+// Sends the user's message to the backend and displays the bot's responses
+// as they arrive, over the WebSocket when connected, otherwise over
+// /chat/stream and finally the plain /chat endpoint (as a job while Rasa is slow)
+async function sendToChatbot(message) {
+  showTypingIndicator();
+
+  if (!useChatJobs) {
+    try {
+      let shown;
+      try {
+        shown = await sendOverSocket(message);
+      } catch (error) {
+        if (error.partial) {
+            throw error;
+        }
+        shown = await streamFromChatbot(message);
+      }
+      hideTypingIndicator();
+      if (shown === 0) {
+          addBotMessage("I'm sorry, I didn't get a response. Please try again.");
+      }
+      return;
+    } catch (error) {
+      if (error.partial) {
+          // Some of the answer is already on screen, don't repeat the question
+          console.error('Error:', error);
+          hideTypingIndicator();
+          return;
+      }
+      console.warn('Streaming failed, falling back to /chat:', error);
+    }
+  }
+
+  try {
+    const response = useChatJobs ? await chatJob(message) : await fetch(basePath + 'chat?fields=text&join=true', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ message: message, sender: sessionId })
+    });
+    if (response.ok) {
+        useChatJobs = response.headers.get('X-Chat-Mode') === 'async';
+    }
+
+    // A 503 means the server is busy and a 429 that we're sending too fast,
+    // their body carries a message for the user
+    if (!response.ok && response.status !== 503 && response.status !== 429) {
+        throw new Error(`HTTP Error: ${response.status}`);
+    }
+
+    const data = await response.json();
+
+    hideTypingIndicator();
+
+    if (data.responses && data.responses.length > 0) {
+        addBotMessage(data.responses[0].text);
+    } else {
+        addBotMessage("I'm sorry, I didn't get a response. Please try again.");
+    }
+
+  } catch (error) {
+    console.error('Error:', error);
+    hideTypingIndicator();
+    addBotMessage("❌ Sorry, I'm having trouble connecting. Please ensure the server is running and try again.");
+  }
+}
+
+// Submits the message as an async job and long-polls until it's answered.
+// Resolves with the final response, which has the same body as /chat's
+async function chatJob(message) {
+  const submitted = await fetch(basePath + 'chat?mode=async', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ message: message, sender: sessionId })
+  });
+  if (submitted.status !== 202) {
+      return submitted;
+  }
+  // Only the texts are shown, already joined by the server
+  const url = submitted.headers.get('Location') + '?fields=text&join=true';
+  while (true) {
+    const response = await fetch(url);
+    if (response.status !== 202) {
+        return response;
+    }
+  }
+}
+
+// Reads the Server-Sent Events from /chat/stream and renders each
+// response as soon as it arrives. Returns how many messages were shown.
+async function streamFromChatbot(message) {
+  const response = await fetch(basePath + 'chat/stream', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
+      body: JSON.stringify({ message: message, sender: sessionId })
+  });
+
+  if (!response.ok || !response.body) {
+      throw new Error(`HTTP Error: ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let shown = 0;
+
+  try {
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) {
+          throw new Error('Stream ended before the answer was complete');
+      }
+      buffer += decoder.decode(value, { stream: true });
+
+      let boundary;
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const frame = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+
+        let event = 'message';
+        let data = '';
+        for (const line of frame.split('\n')) {
+          if (line.startsWith('event: ')) event = line.slice(7);
+          else if (line.startsWith('data: ')) data += line.slice(6);
+        }
+
+        if (event === 'done') {
+            useChatJobs = data !== '' && JSON.parse(data).mode === 'async';
+            return shown;
+        }
+        if ((event === 'message' || event === 'overloaded') && data) {
+            const resp = JSON.parse(data);
+            if (resp.text) {
+                addBotMessage(resp.text);
+                shown++;
+            }
+        }
+      }
+    }
+  } catch (error) {
+    error.partial = shown > 0;
+    throw error;
+  }
+}
+
+// Initialize chatbot with a hardcoded welcome message on page load
+document.addEventListener('DOMContentLoaded', function() {
+  const welcomeMessage = "Hi, I am VaspX, an assistant of Vasp Technologies, how can I assist you today?";
+  addBotMessage(welcomeMessage);
+  connectSocket();
+});
+
+// Cache the page and its files so repeat visits start without the network
+if ('serviceWorker' in navigator) {
+  window.addEventListener('load', function() {
+    navigator.serviceWorker.register(basePath + 'sw.js', { scope: basePath }).catch(function(error) {
+      console.warn('Service worker registration failed:', error);
+    });
+  });
+}
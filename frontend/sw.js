@@ -0,0 +1,86 @@
+// Service worker: keeps the page, its stylesheet and script and the images in
+// a cache so returning visitors get the chat without touching the network.
+// The server fills in VERSION (a hash of the built page) and SHELL (the page's
+// fingerprinted files) when it builds the frontend, so every deploy changes this
+// file, which makes the browser install the new worker in the background.
+const VERSION = '__VERSION__';
+const SHELL = __SHELL__;
+const CACHE_PREFIX = 'vasp-chat-';
+const CACHE_NAME = CACHE_PREFIX + VERSION;
+
+// The page this worker controls, e.g. "/" or "/bots/<name>/"
+const PAGE_URL = self.registration.scope;
+
+self.addEventListener('install', function(event) {
+  event.waitUntil(
+    caches.open(CACHE_NAME)
+      .then(function(cache) { return cache.addAll([PAGE_URL].concat(SHELL)); })
+      .then(function() { return self.skipWaiting(); })
+  );
+});
+
+// Drop the caches of earlier versions once this one takes over
+self.addEventListener('activate', function(event) {
+  event.waitUntil(
+    caches.keys()
+      .then(function(names) {
+        return Promise.all(names
+          .filter(function(name) { return name.startsWith(CACHE_PREFIX) && name !== CACHE_NAME; })
+          .map(function(name) { return caches.delete(name); }));
+      })
+      .then(function() { return self.clients.claim(); })
+  );
+});
+
+function isPage(request, url) {
+  return request.mode === 'navigate' && url.origin + url.pathname === PAGE_URL;
+}
+
+// Fingerprinted URLs never change content, the plain names are revalidated by the server
+function isImmutable(url) {
+  return /^\/(static|assets)\/[^/]+\.[0-9a-f]{12}\.[^/.]+$/.test(url.pathname);
+}
+
+// Serves the cached page right away and refreshes the copy for the next visit
+function pageFromCache(event) {
+  const refresh = fetch(event.request).then(function(response) {
+    if (response.ok) {
+      const copy = response.clone();
+      caches.open(CACHE_NAME).then(function(cache) { return cache.put(PAGE_URL, copy); });
+    }
+    return response;
+  });
+  event.waitUntil(refresh.catch(function() {}));
+  return caches.match(PAGE_URL, { cacheName: CACHE_NAME }).then(function(cached) {
+    return cached || refresh;
+  });
+}
+
+function fileFromCache(request) {
+  return caches.match(request, { cacheName: CACHE_NAME }).then(function(cached) {
+    return cached || fetch(request).then(function(response) {
+      if (response.ok) {
+        const copy = response.clone();
+        caches.open(CACHE_NAME).then(function(cache) { return cache.put(request, copy); });
+      }
+      return response;
+    });
+  });
+}
+
+// Everything else (chat API, WebSocket, health checks) goes straight to the network
+self.addEventListener('fetch', function(event) {
+  const request = event.request;
+  if (request.method !== 'GET') {
+    return;
+  }
+  const url = new URL(request.url);
+  if (url.origin !== location.origin) {
+    return;
+  }
+  if (isPage(request, url)) {
+    event.respondWith(pageFromCache(event));
+  } else if (isImmutable(url)) {
+    event.respondWith(fileFromCache(request));
+  }
+});
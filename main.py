@@ -1,23 +1,2019 @@
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from starlette.requests import ClientDisconnect, HTTPConnection
+from collections import OrderedDict, deque
+import asyncio
+import bisect
+import gzip
+import hashlib
+import hmac
 import httpx
-from typing import Dict
+import io
+import json
+import math
+import mimetypes
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 import os
+import random
+import re
+import secrets
+import sqlite3
+import sys
+import threading
+import time
 from dotenv import load_dotenv
 
-app = FastAPI()
+try:
+    import brotli
+except ImportError:  # Optional, pages are still served gzipped without it
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # Optional, images are served in their original format without it
+    Image = None
+
+try:
+    import orjson
+except ImportError:  # Optional, the standard json module is used without it
+    orjson = None
 
 load_dotenv()
 
-# --- Configuration ---
-# Mount the assets directory to serve images like your logo
-if os.path.exists("assets"):
-    app.mount("/assets", StaticFiles(directory="assets"), name="assets")
 
-# URL for your running Rasa server
-RASA_SERVER_URL = f"{os.getenv('RASA_SERVER_URL')}/webhooks/rest/webhook"
+def env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def dumps(data) -> str:
+    if orjson is not None:
+        return orjson.dumps(data).decode("utf-8")
+    return json.dumps(data)
+
+
+def dumps_bytes(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode("utf-8")
+
+
+def loads(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_response(content, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    Encodes straight to bytes (with orjson when available). Returning a
+    Response skips FastAPI's generic jsonable_encoder pass over the content.
+    """
+    return Response(content=dumps_bytes(content), status_code=status_code, headers=headers, media_type="application/json")
+
+
+# --- Configuration ---
+# Base URL of your running Rasa server
+RASA_BASE_URL = os.getenv("RASA_SERVER_URL")
+# Several Rasa servers can share the load: a comma separated list of base URLs.
+# Each sender sticks to one of them so its tracker stays on the same server.
+RASA_SERVER_URLS = [
+    url.strip().rstrip("/")
+    for url in (os.getenv("RASA_SERVER_URLS") or RASA_BASE_URL or "").split(",")
+    if url.strip()
+]
+
+# More bots served from this deployment, each with its own Rasa servers,
+# connection pool, admission limit and timeouts (see tenants.example.json). A
+# request picks a bot with a /bots/<name>/ path prefix, its Host header or a
+# "bot" field, anything else goes to the default bot configured above. The file
+# is checked for changes every TENANTS_RELOAD_INTERVAL seconds and reloaded
+# without a restart.
+TENANTS_FILE = os.getenv("TENANTS_FILE", "")
+TENANTS_RELOAD_INTERVAL = env_float("TENANTS_RELOAD_INTERVAL", 5.0)
+
+# Backend health: active probes of each server's base URL, and a circuit breaker
+# that ejects a backend after repeated failures for a cooldown that doubles each
+# time it is ejected again (up to RASA_BREAKER_MAX_COOLDOWN)
+RASA_HEALTH_INTERVAL = env_float("RASA_HEALTH_INTERVAL", 5.0)
+RASA_HEALTH_TIMEOUT = env_float("RASA_HEALTH_TIMEOUT", 2.0)
+RASA_UNHEALTHY_THRESHOLD = env_int("RASA_UNHEALTHY_THRESHOLD", 2)
+RASA_BREAKER_FAILURES = env_int("RASA_BREAKER_FAILURES", 5)
+RASA_BREAKER_COOLDOWN = env_float("RASA_BREAKER_COOLDOWN", 10.0)
+RASA_BREAKER_MAX_COOLDOWN = env_float("RASA_BREAKER_MAX_COOLDOWN", 300.0)
+# A backend whose average latency is this many times the median of the others is ejected too (0 disables)
+RASA_OUTLIER_LATENCY_FACTOR = env_float("RASA_OUTLIER_LATENCY_FACTOR", 3.0)
+RASA_OUTLIER_MIN_REQUESTS = env_int("RASA_OUTLIER_MIN_REQUESTS", 20)
+# Virtual nodes per backend on the consistent hash ring
+RASA_RING_REPLICAS = env_int("RASA_RING_REPLICAS", 100)
+# /health/ready fails when the last probe round is older than this (the monitor is stuck)
+RASA_READY_MAX_PROBE_AGE = env_float("RASA_READY_MAX_PROBE_AGE", 3 * RASA_HEALTH_INTERVAL + RASA_HEALTH_TIMEOUT)
+
+# Admission control: at most RASA_MAX_CONCURRENCY requests to Rasa at once per
+# worker. Up to RASA_QUEUE_SIZE more wait for at most RASA_QUEUE_TIMEOUT seconds,
+# anything beyond that is rejected right away with a 503 and Retry-After.
+RASA_MAX_CONCURRENCY = env_int("RASA_MAX_CONCURRENCY", 64)
+RASA_QUEUE_SIZE = env_int("RASA_QUEUE_SIZE", 256)
+RASA_QUEUE_TIMEOUT = env_float("RASA_QUEUE_TIMEOUT", 5.0)
+RASA_RETRY_AFTER = env_int("RASA_RETRY_AFTER", 5)
+# Adaptive limit (AIMD): grows by one while Rasa answers within RASA_TARGET_LATENCY,
+# shrinks by 10% when it doesn't, between the min and max below
+RASA_ADAPTIVE_CONCURRENCY = env_bool("RASA_ADAPTIVE_CONCURRENCY")
+RASA_TARGET_LATENCY = env_float("RASA_TARGET_LATENCY", 2.0)
+RASA_MIN_CONCURRENCY = env_int("RASA_MIN_CONCURRENCY", 4)
+RASA_MAX_CONCURRENCY_LIMIT = env_int("RASA_MAX_CONCURRENCY_LIMIT", 256)
+OVERLOADED_MESSAGE = "We're receiving a lot of messages right now. Please try again in a few seconds."
+
+# Token bucket rate limits on chat turns, per sender and per client IP: each key
+# may send a burst of *_BURST turns, refilled at *_RATE turns per second (a rate
+# of 0 disables that limit). Behind a proxy, set FORWARDED_ALLOW_IPS so the
+# client IP comes from X-Forwarded-For. RATE_LIMIT_STORE is "memory" (per
+# worker) or "sqlite:<path>" to share the buckets between the workers of a host,
+# e.g. sqlite:/dev/shm/ratelimit.db.
+RATE_LIMIT_SENDER_RATE = env_float("RATE_LIMIT_SENDER_RATE", 1.0)
+RATE_LIMIT_SENDER_BURST = env_int("RATE_LIMIT_SENDER_BURST", 10)
+RATE_LIMIT_IP_RATE = env_float("RATE_LIMIT_IP_RATE", 5.0)
+RATE_LIMIT_IP_BURST = env_int("RATE_LIMIT_IP_BURST", 50)
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+# Keys tracked per limiter in memory; the least recently used are forgotten beyond it
+RATE_LIMIT_MAX_KEYS = env_int("RATE_LIMIT_MAX_KEYS", 100000)
+RATE_LIMITED_MESSAGE = "You're sending messages too quickly. Please wait a moment and try again."
+
+# Connection pool shared by every request to Rasa
+RASA_MAX_CONNECTIONS = env_int("RASA_MAX_CONNECTIONS", 100)
+RASA_MAX_KEEPALIVE_CONNECTIONS = env_int("RASA_MAX_KEEPALIVE_CONNECTIONS", 20)
+RASA_KEEPALIVE_EXPIRY = env_float("RASA_KEEPALIVE_EXPIRY", 30.0)
+RASA_HTTP2 = env_bool("RASA_HTTP2")
+# Number of connections opened to Rasa at startup so the first users don't pay for the handshake
+RASA_WARMUP_CONNECTIONS = env_int("RASA_WARMUP_CONNECTIONS", 4)
+
+# Timeouts (seconds) for talking to Rasa
+RASA_CONNECT_TIMEOUT = env_float("RASA_CONNECT_TIMEOUT", 5.0)
+RASA_READ_TIMEOUT = env_float("RASA_READ_TIMEOUT", 30.0)
+RASA_WRITE_TIMEOUT = env_float("RASA_WRITE_TIMEOUT", 10.0)
+RASA_POOL_TIMEOUT = env_float("RASA_POOL_TIMEOUT", 5.0)
+
+# Response cache for stateless, FAQ-style messages.
+# Only messages matching one of the CHAT_CACHE_ALLOW patterns (comma separated
+# regexes, matched against the normalized message) are cached; CHAT_CACHE_DENY
+# patterns always win so forms and slot filling never see a cached answer.
+CHAT_CACHE_MAX_ENTRIES = env_int("CHAT_CACHE_MAX_ENTRIES", 1024)
+CHAT_CACHE_TTL = env_float("CHAT_CACHE_TTL", 300.0)
+CHAT_CACHE_ALLOW = os.getenv("CHAT_CACHE_ALLOW", "")
+CHAT_CACHE_DENY = os.getenv("CHAT_CACHE_DENY", "")
+# Serve an expired entry (up to CHAT_CACHE_STALE_TTL seconds old) when Rasa is failing
+CHAT_CACHE_SERVE_STALE = env_bool("CHAT_CACHE_SERVE_STALE", True)
+CHAT_CACHE_STALE_TTL = env_float("CHAT_CACHE_STALE_TTL", 3600.0)
+
+# Fast path: greetings, thanks and top FAQs answered in-process from a JSON file
+# of phrases and responses (see fast_path.example.json) instead of going to Rasa.
+# A message is answered when the phrases of one entry cover at least
+# FAST_PATH_MIN_CONFIDENCE of its words. Empty FAST_PATH_FILE disables it.
+FAST_PATH_FILE = os.getenv("FAST_PATH_FILE", "")
+FAST_PATH_MIN_CONFIDENCE = env_float("FAST_PATH_MIN_CONFIDENCE", 0.8)
+
+# Limits on incoming chat messages
+CHAT_MAX_MESSAGE_LENGTH = env_int("CHAT_MAX_MESSAGE_LENGTH", 2000)
+CHAT_MAX_SENDER_LENGTH = env_int("CHAT_MAX_SENDER_LENGTH", 128)
+# Pass Rasa's response body through to /chat clients without decoding it
+CHAT_RAW_PASSTHROUGH = env_bool("CHAT_RAW_PASSTHROUGH", True)
+
+# /chat bodies of at least this many bytes are sent compressed (brotli or gzip)
+# to clients that accept it, 0 disables
+CHAT_COMPRESS_MIN_BYTES = env_int("CHAT_COMPRESS_MIN_BYTES", 1024)
+
+# Seconds between SSE heartbeat comments on /chat/stream while waiting for Rasa
+CHAT_STREAM_HEARTBEAT = env_float("CHAT_STREAM_HEARTBEAT", 10.0)
+
+# /chat/batch: how many turns run at once (turns of one sender always run in
+# order), how many lines may be read ahead of the results, and how many times a
+# turn rejected by admission control is retried
+CHAT_BATCH_CONCURRENCY = env_int("CHAT_BATCH_CONCURRENCY", 16)
+CHAT_BATCH_MAX_PENDING = env_int("CHAT_BATCH_MAX_PENDING", 1000)
+CHAT_BATCH_RETRIES = env_int("CHAT_BATCH_RETRIES", 3)
+# Bearer token for /chat/batch, which bypasses the rate limits; the endpoint doesn't exist while it's unset
+CHAT_BATCH_TOKEN = os.getenv("CHAT_BATCH_TOKEN", "")
+
+# Async job mode (POST /chat?mode=async, then GET /chat/jobs/{id}): how many
+# turns run at once, how many may wait, how long finished results are kept and
+# the longest a poll is held open. While Rasa's recent latency is above
+# CHAT_ASYNC_LATENCY_HINT seconds (0 never hints), /chat responses carry
+# "X-Chat-Mode: async" and the /chat/stream "done" event and /ws "done" frame
+# carry "mode": "async", which makes the page switch to job mode.
+CHAT_JOB_WORKERS = env_int("CHAT_JOB_WORKERS", 16)
+CHAT_JOB_QUEUE_SIZE = env_int("CHAT_JOB_QUEUE_SIZE", 1000)
+CHAT_JOB_TTL = env_float("CHAT_JOB_TTL", 300.0)
+CHAT_JOB_POLL_TIMEOUT = env_float("CHAT_JOB_POLL_TIMEOUT", 25.0)
+CHAT_ASYNC_LATENCY_HINT = env_float("CHAT_ASYNC_LATENCY_HINT", 5.0)
+
+# WebSocket sessions on /ws: seconds between pings, and how long a session may go
+# without a user message before the server closes it (the page reconnects on demand)
+WS_PING_INTERVAL = env_float("WS_PING_INTERVAL", 20.0)
+WS_IDLE_TIMEOUT = env_float("WS_IDLE_TIMEOUT", 300.0)
+# Turns a session may have waiting behind the one being answered; more are
+# answered with an "overloaded" frame instead of piling up in memory
+WS_MAX_PENDING_TURNS = env_int("WS_MAX_PENDING_TURNS", 16)
+
+# Sampling profiler for /chat requests, off by default. A request is profiled
+# when its X-Profile header equals PROFILE_SECRET, or at random for a
+# PROFILE_SAMPLE_RATE fraction of requests. Stacks of the event loop thread are
+# sampled every PROFILE_INTERVAL seconds and written to PROFILE_DIR in the
+# collapsed format read by flamegraph.pl and speedscope.
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "")
+PROFILE_SAMPLE_RATE = env_float("PROFILE_SAMPLE_RATE", 0.0)
+PROFILE_INTERVAL = env_float("PROFILE_INTERVAL", 0.001)
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Shadow traffic for trying out a candidate Rasa model under real load: the
+# turns (over any transport) of a SHADOW_SAMPLE_RATE fraction of senders are
+# replayed, after the user got the answer, to SHADOW_RASA_URL (a bot in
+# TENANTS_FILE sets its own "shadow_url") as sender SHADOW_SENDER_PREFIX + id.
+# At most SHADOW_QUEUE_SIZE turns, split evenly between the SHADOW_CONCURRENCY
+# replay workers (a sender always uses the same one), may wait, more are
+# dropped. Latency and answer differences are written to a JSON report per
+# worker process in SHADOW_REPORT_DIR every SHADOW_REPORT_INTERVAL seconds.
+SHADOW_RASA_URL = os.getenv("SHADOW_RASA_URL", "").strip().rstrip("/")
+SHADOW_SAMPLE_RATE = env_float("SHADOW_SAMPLE_RATE", 0.0)
+SHADOW_SENDER_PREFIX = os.getenv("SHADOW_SENDER_PREFIX", "shadow-")
+SHADOW_QUEUE_SIZE = env_int("SHADOW_QUEUE_SIZE", 1000)
+SHADOW_CONCURRENCY = env_int("SHADOW_CONCURRENCY", 8)
+SHADOW_TIMEOUT = env_float("SHADOW_TIMEOUT", 30.0)
+SHADOW_REPORT_DIR = os.getenv("SHADOW_REPORT_DIR", "shadow_reports")
+SHADOW_REPORT_INTERVAL = env_float("SHADOW_REPORT_INTERVAL", 30.0)
+# Turns kept for the latency percentiles, and differing answers kept as examples
+SHADOW_LATENCY_SAMPLES = env_int("SHADOW_LATENCY_SAMPLES", 10000)
+SHADOW_REPORT_EXAMPLES = env_int("SHADOW_REPORT_EXAMPLES", 20)
+
+# Conversation transcripts are written behind the response to a SQLite file
+# (empty TRANSCRIPT_DB disables them). Turns wait in a queue of at most
+# TRANSCRIPT_QUEUE_SIZE entries, anything beyond is dropped and counted, and are
+# written TRANSCRIPT_BATCH_SIZE at a time or every TRANSCRIPT_FLUSH_INTERVAL seconds.
+TRANSCRIPT_DB = os.getenv("TRANSCRIPT_DB", "transcripts.db")
+TRANSCRIPT_QUEUE_SIZE = env_int("TRANSCRIPT_QUEUE_SIZE", 10000)
+TRANSCRIPT_BATCH_SIZE = env_int("TRANSCRIPT_BATCH_SIZE", 200)
+TRANSCRIPT_FLUSH_INTERVAL = env_float("TRANSCRIPT_FLUSH_INTERVAL", 1.0)
+# Bearer token for GET /transcripts/{sender}; the endpoint doesn't exist while it's unset
+TRANSCRIPT_ADMIN_TOKEN = os.getenv("TRANSCRIPT_ADMIN_TOKEN", "")
+
+
+# --- Upstream client ---
+# One client per bot and worker keeps connections to Rasa alive between
+# messages. It is created when the bot starts and closed when it stops.
+def create_http_client(max_connections: int, timeout: httpx.Timeout) -> httpx.AsyncClient:
+    http2 = RASA_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            print("RASA_HTTP2 is enabled but the 'h2' package is not installed; falling back to HTTP/1.1")
+            http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=min(RASA_MAX_KEEPALIVE_CONNECTIONS, max_connections),
+            keepalive_expiry=RASA_KEEPALIVE_EXPIRY,
+        ),
+        timeout=timeout,
+    )
+
+
+async def warm_up_http_client(client: httpx.AsyncClient, backends: List["RasaBackend"]):
+    """
+    Opens a few connections to each Rasa server in parallel so they sit in
+    the pool before the first user message arrives. Failures are logged and
+    ignored, the app still starts if Rasa isn't up yet.
+    """
+    if RASA_WARMUP_CONNECTIONS <= 0:
+        return
+
+    async def ping(url: str):
+        try:
+            await client.get(url)
+        except httpx.HTTPError as e:
+            print(f"Warmup request to Rasa at {url} failed: {e}")
+
+    await asyncio.gather(*(
+        ping(backend.base_url)
+        for backend in backends
+        for _ in range(RASA_WARMUP_CONNECTIONS)
+    ))
+
+
+# --- Metrics ---
+# Plain counters and fixed-bucket histograms exported in Prometheus text format
+# on /metrics. Everything runs on the event loop thread, so updates are just
+# integer additions with no locking. Each worker process keeps its own numbers.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items()) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(dict(zip(self.labels, label_values)))} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {cumulative}')
+        cumulative += self.counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {self.sum:g}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+def gauge(name: str, help: str, samples: List[Tuple[Dict[str, str], float]], kind: str = "gauge") -> List[str]:
+    """Renders values read from elsewhere at scrape time; kind="counter" for ever-increasing totals."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{format_labels(labels)} {value:g}" for labels, value in samples)
+    return lines
+
+
+CHAT_REQUESTS = Counter("chatbot_requests_total", "Chat turns received, by transport", ("transport",))
+RATE_LIMITED = Counter("chatbot_rate_limited_total", "Turns rejected by a rate limit, by scope", ("scope",))
+FAST_PATH_LOOKUPS = Counter("chatbot_fast_path_lookups_total", "Fast path lookups, by bot and result", ("bot", "result"))
+FAST_PATH_ANSWERS = Counter("chatbot_fast_path_answers_total", "Turns answered by the fast path, by bot and entry", ("bot", "answer"))
+FAST_PATH_NOTIFICATIONS = Counter("chatbot_fast_path_notifications_total", "Fast path turns replayed to Rasa, by bot and outcome", ("bot", "outcome"))
+CHAT_ERRORS = Counter("chatbot_errors_total", "Turns answered with an error message, by kind", ("kind",))
+TURN_SECONDS = Histogram("chatbot_turn_seconds", "Time to answer a turn, including waiting for the sender's earlier turns")
+UPSTREAM_QUEUE_SECONDS = Histogram("chatbot_upstream_queue_seconds", "Time spent waiting for an admission slot")
+UPSTREAM_CONNECT_SECONDS = Histogram("chatbot_upstream_connect_seconds", "Time to open a new connection to Rasa (TCP + TLS)")
+UPSTREAM_TTFB_SECONDS = Histogram("chatbot_upstream_ttfb_seconds", "Time from sending a request to Rasa until its response headers arrived")
+UPSTREAM_SECONDS = Histogram("chatbot_upstream_seconds", "Total time of a request to Rasa, body included")
+TRANSCRIPT_FLUSH_SECONDS = Histogram("chatbot_transcript_flush_seconds", "Time to write one batch of transcript entries")
+METRICS = [
+    CHAT_REQUESTS, CHAT_ERRORS, RATE_LIMITED, FAST_PATH_LOOKUPS, FAST_PATH_ANSWERS, FAST_PATH_NOTIFICATIONS, TURN_SECONDS, UPSTREAM_QUEUE_SECONDS, UPSTREAM_CONNECT_SECONDS,
+    UPSTREAM_TTFB_SECONDS, UPSTREAM_SECONDS, TRANSCRIPT_FLUSH_SECONDS,
+]
+turns_in_flight = 0
+
+
+class UpstreamTimer:
+    """Timings of one request to Rasa, filled in from httpx trace events."""
+
+    def __init__(self):
+        self.queue = 0.0
+        self.connect = 0.0
+        self.ttfb: Optional[float] = None
+        self.total = 0.0
+        self.started = time.perf_counter()
+        self.connect_started = 0.0
+
+    async def trace(self, event_name: str, info: Dict):
+        now = time.perf_counter()
+        if event_name in ("connection.connect_tcp.started", "connection.start_tls.started"):
+            self.connect_started = now
+        elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            self.connect += now - self.connect_started
+        elif event_name.endswith("receive_response_headers.complete") and self.ttfb is None:
+            self.ttfb = now - self.started
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+        UPSTREAM_QUEUE_SECONDS.observe(self.queue)
+        if self.connect:
+            UPSTREAM_CONNECT_SECONDS.observe(self.connect)
+        if self.ttfb is not None:
+            UPSTREAM_TTFB_SECONDS.observe(self.ttfb)
+        UPSTREAM_SECONDS.observe(self.total)
+        timing = turn_timing.get()
+        if timing is not None:
+            timing.record_upstream(self)
+
+
+class TurnTiming:
+    """
+    Where the time of one /chat request went, reported in its Server-Timing
+    header. Reached through the turn_timing context variable, so the code
+    deeper in the turn doesn't need it passed along.
+    """
+
+    def __init__(self, received_at: float):
+        self.received_at = received_at
+        self.handler_started = time.perf_counter()
+        self.turn_started = self.handler_started
+        self.queue = 0.0
+        self.connect = 0.0
+        self.upstream: Optional[float] = None
+        self.serialize_started: Optional[float] = None
+
+    def record_upstream(self, timer: "UpstreamTimer"):
+        self.queue += timer.queue
+        self.connect += timer.connect
+        self.upstream = (self.upstream or 0.0) + timer.total - timer.connect
+
+    def upstream_seconds(self) -> Optional[float]:
+        """Time spent in requests to Rasa, None when the answer didn't come from Rasa."""
+        return None if self.upstream is None else self.upstream + self.connect
+
+    def header(self) -> str:
+        now = time.perf_counter()
+        phases = [("parse", self.handler_started - self.received_at), ("queue", self.queue)]
+        if self.upstream is not None:
+            phases += [("connect", self.connect), ("upstream", self.upstream)]
+        if self.serialize_started is not None:
+            phases.append(("serialize", now - self.serialize_started))
+        phases.append(("total", now - self.received_at))
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in phases)
+
+
+turn_timing: ContextVar[Optional[TurnTiming]] = ContextVar("turn_timing", default=None)
+
+
+def pool_connections(client: Optional[httpx.AsyncClient]) -> Dict[str, int]:
+    """Connections currently held by an httpx pool (relies on httpcore internals, empty if they change)."""
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    idle = sum(1 for c in connections if getattr(c, "is_idle", lambda: False)())
+    return {"active": len(connections) - idle, "idle": idle}
+
+
+# --- Rasa backends ---
+class RasaBackend:
+    """
+    One Rasa server with its circuit breaker and request counters.
+
+    The breaker is "closed" while requests succeed, "open" (ejected) for a
+    cooldown after RASA_BREAKER_FAILURES consecutive failures, then
+    "half_open" where a single trial request decides whether it closes again.
+    """
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.webhook_url = f"{base_url}/webhooks/rest/webhook"
+        self.healthy = True
+        self.failed_probes = 0
+        # Outcome of the most recent probe, None until the first one ran
+        self.last_probe_ok: Optional[bool] = None
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.open_until = 0.0
+        self.trial_in_flight = False
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.latency_total = 0.0
+        self.latency_ewma = 0.0
+
+    def available(self) -> bool:
+        if not self.healthy:
+            return False
+        if self.state == "open" and time.monotonic() >= self.open_until:
+            self.state = "half_open"
+        if self.state == "half_open":
+            return not self.trial_in_flight
+        return self.state == "closed"
+
+    def eject(self, reason: str):
+        self.ejections += 1
+        cooldown = min(RASA_BREAKER_COOLDOWN * 2 ** (self.ejections - 1), RASA_BREAKER_MAX_COOLDOWN)
+        self.state = "open"
+        self.open_until = time.monotonic() + cooldown
+        print(f"Ejecting Rasa backend {self.base_url} for {cooldown:.0f}s: {reason}")
+
+    def record_success(self, latency: float):
+        self.latency_total += latency
+        self.latency_ewma = latency if not self.latency_ewma else 0.8 * self.latency_ewma + 0.2 * latency
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            self.state = "closed"
+            self.ejections = 0
+
+    def record_failure(self, error: Exception):
+        self.errors += 1
+        self.consecutive_failures += 1
+        # Requests that were already in flight when the backend got ejected don't eject it again
+        if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= RASA_BREAKER_FAILURES):
+            self.eject(f"{self.consecutive_failures} consecutive failures ({error!r})")
+
+    @asynccontextmanager
+    async def track(self):
+        """Wraps one request to this backend, feeding its outcome to the counters and the breaker."""
+        self.requests += 1
+        self.in_flight += 1
+        start = time.monotonic()
+        try:
+            yield
+        except httpx.HTTPStatusError as e:
+            # A 4xx means the request was bad, not that the server is
+            if e.response.status_code >= 500:
+                self.record_failure(e)
+            else:
+                self.errors += 1
+            raise
+        except (httpx.RequestError, ValueError) as e:
+            self.record_failure(e)
+            raise
+        else:
+            self.record_success(time.monotonic() - start)
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> Dict:
+        successes = self.requests - self.errors - self.in_flight
+        return {
+            "url": self.base_url,
+            "healthy": self.healthy,
+            "last_probe_ok": self.last_probe_ok,
+            "state": self.state,
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "ejections": self.ejections,
+            "latency_avg": self.latency_total / successes if successes > 0 else 0.0,
+            "latency_ewma": self.latency_ewma,
+        }
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class RasaBackends:
+    """
+    Routes each sender to a Rasa server with consistent hashing. When a
+    server is unavailable its senders move to the next server on the ring
+    and every other sender stays where it was.
+    """
+
+    def __init__(self, urls: List[str]):
+        self.backends = [RasaBackend(url) for url in urls]
+        self.ring = sorted(
+            (ring_hash(f"{backend.base_url}#{replica}"), index)
+            for index, backend in enumerate(self.backends)
+            for replica in range(RASA_RING_REPLICAS)
+        )
+        self.ring_keys = [point for point, _ in self.ring]
+        self.probed_at = 0.0
+
+    def pick(self, sender_id: str) -> Tuple[RasaBackend, bool]:
+        """
+        The sender's backend, and whether this request is its half-open
+        trial. The trial is claimed here, before the request waits for an
+        admission slot, so nothing else is routed to the backend meanwhile;
+        the caller hands the flag to upstream_call, which releases it.
+        """
+        if not self.backends:
+            raise RuntimeError("No Rasa server configured, set RASA_SERVER_URL")
+
+        start = bisect.bisect(self.ring_keys, ring_hash(sender_id))
+        tried = set()
+        for offset in range(len(self.ring)):
+            index = self.ring[(start + offset) % len(self.ring)][1]
+            if index in tried:
+                continue
+            backend = self.backends[index]
+            if backend.available():
+                trial = backend.state == "half_open"
+                if trial:
+                    backend.trial_in_flight = True
+                return backend, trial
+            tried.add(index)
+            if len(tried) == len(self.backends):
+                break
+        # Nothing is available: keep the sender on its own server rather than fail outright
+        return self.backends[self.ring[start % len(self.ring)][1]], False
+
+    async def probe(self, client: httpx.AsyncClient, backend: RasaBackend):
+        try:
+            response = await client.get(backend.base_url, timeout=RASA_HEALTH_TIMEOUT)
+            ok = response.status_code < 500
+        except httpx.HTTPError:
+            ok = False
+
+        backend.last_probe_ok = ok
+        if ok:
+            backend.failed_probes = 0
+            backend.healthy = True
+        else:
+            backend.failed_probes += 1
+            if backend.failed_probes >= RASA_UNHEALTHY_THRESHOLD and backend.healthy:
+                print(f"Rasa backend {backend.base_url} failed {backend.failed_probes} health checks")
+                backend.healthy = False
+
+    def eject_latency_outliers(self):
+        if RASA_OUTLIER_LATENCY_FACTOR <= 0 or len(self.backends) < 3:
+            return
+        sampled = [b for b in self.backends if b.state == "closed" and b.requests >= RASA_OUTLIER_MIN_REQUESTS]
+        for backend in sampled:
+            others = sorted(b.latency_ewma for b in sampled if b is not backend)
+            if not others:
+                continue
+            median = others[len(others) // 2]
+            if median > 0 and backend.latency_ewma > RASA_OUTLIER_LATENCY_FACTOR * median:
+                backend.eject(f"latency {backend.latency_ewma:.2f}s vs median {median:.2f}s")
+
+    async def probe_all(self, client: httpx.AsyncClient):
+        await asyncio.gather(*(self.probe(client, backend) for backend in self.backends))
+        self.probed_at = time.monotonic()
+
+    async def monitor(self, client: httpx.AsyncClient):
+        """Background task: probes every backend and ejects latency outliers. The first round runs at startup."""
+        while True:
+            await asyncio.sleep(RASA_HEALTH_INTERVAL)
+            await self.probe_all(client)
+            self.eject_latency_outliers()
+
+    def readiness(self) -> Optional[str]:
+        """
+        Why this worker can't answer chats right now, or None when it can:
+        the latest probe round has to be recent and at least one server must
+        have answered it with its breaker not open.
+        """
+        if not self.backends:
+            return "no Rasa server configured"
+        if time.monotonic() - self.probed_at > RASA_READY_MAX_PROBE_AGE:
+            return "Rasa servers have not been probed recently"
+        if not any(b.last_probe_ok and b.state != "open" for b in self.backends):
+            return "no Rasa server is reachable"
+        return None
+
+    def recent_latency(self) -> float:
+        """Average of the backends' recent latencies, those that answered anything."""
+        latencies = [b.latency_ewma for b in self.backends if b.latency_ewma]
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+    def stats(self) -> List[Dict]:
+        return [backend.stats() for backend in self.backends]
+
+
+
+# --- Admission control ---
+class UpstreamOverloaded(Exception):
+    """Raised when a request to Rasa can't be admitted, either the queue is full or the wait ran out."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Rasa is overloaded, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limits how many requests to Rasa run at once. Callers over the limit wait
+    in FIFO order in a bounded queue; a slot freed by a finished request is
+    handed directly to the oldest waiter.
+    """
+
+    def __init__(self, limit: int, queue_size: int, queue_timeout: float, adaptive: bool):
+        self.limit = float(limit)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.adaptive = adaptive
+        self.in_flight = 0
+        self.waiters: deque = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.fast_completions = 0
+        self.last_decrease = 0.0
+
+    async def acquire(self) -> float:
+        """Waits for a slot and returns how long that took."""
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return 0.0
+
+        if len(self.waiters) >= self.queue_size:
+            self.rejected += 1
+            raise UpstreamOverloaded(RASA_RETRY_AFTER)
+
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise UpstreamOverloaded(RASA_RETRY_AFTER)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release() # The slot was handed to us just as we were cancelled
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+        self.admitted += 1
+        return time.monotonic() - start
+
+    def release(self, latency: Optional[float] = None):
+        self.in_flight -= 1
+        if self.adaptive and latency is not None:
+            self.adapt(latency)
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def adapt(self, latency: float):
+        now = time.monotonic()
+        if latency > RASA_TARGET_LATENCY:
+            # Requests that were already in flight don't all shrink the limit again
+            if now - self.last_decrease > RASA_TARGET_LATENCY:
+                self.limit = max(RASA_MIN_CONCURRENCY, self.limit * 0.9)
+                self.last_decrease = now
+            self.fast_completions = 0
+        else:
+            self.fast_completions += 1
+            if self.fast_completions >= int(self.limit):
+                self.limit = min(RASA_MAX_CONCURRENCY_LIMIT, self.limit + 1)
+                self.fast_completions = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        """Holds a slot for the duration of the block, yielding how long it waited for it."""
+        waited = await self.acquire()
+        start = time.monotonic()
+        try:
+            yield waited
+        finally:
+            self.release(time.monotonic() - start)
+
+    def stats(self) -> Dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+
+
+def overloaded_response(error: UpstreamOverloaded) -> Response:
+    return json_response(
+        {"responses": [{"text": OVERLOADED_MESSAGE}]},
+        status_code=503,
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+
+# --- Rate limiting ---
+class RateLimited(Exception):
+    """Raised when a turn is over its sender's or its client's rate limit."""
+
+    def __init__(self, retry_after: float, scope: str):
+        super().__init__(f"Rate limited by {scope}, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+        self.scope = scope
+
+
+class MemoryBucketStore:
+    """
+    Token buckets of one worker: key -> [tokens, last update]. Keys are kept
+    in least recently used order, so idle ones (whose bucket has refilled
+    and is no different from a new one) are evicted from the front.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.idle_after = burst / rate
+        self.buckets: OrderedDict = OrderedDict()
+
+    async def take(self, key: str) -> float:
+        """Takes a token; returns 0 when there was one, else the seconds until there is."""
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [float(self.burst), now]
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        self.evict(now)
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / self.rate
+
+    def evict(self, now: float):
+        while self.buckets:
+            key, (tokens, updated) = next(iter(self.buckets.items()))
+            if len(self.buckets) <= self.max_keys and now - updated < self.idle_after:
+                break
+            del self.buckets[key]
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+
+class SQLiteBucketStore:
+    """
+    Token buckets in a SQLite file shared by every worker of the host (put it
+    on tmpfs such as /dev/shm to keep it in memory). Each take is one short
+    write transaction run in a worker thread.
+    """
+
+    EVICT_EVERY = 1000
+
+    def __init__(self, path: str, table: str, rate: float, burst: int):
+        self.path = path
+        self.table = table
+        self.rate = rate
+        self.burst = burst
+        self.idle_after = burst / rate
+        self.connection: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+        self.takes = 0
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=OFF")
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        return connection
+
+    def take_sync(self, key: str) -> float:
+        # Wall clock time, the monotonic clock isn't comparable between processes everywhere
+        now = time.time()
+        with self.lock:
+            if self.connection is None:
+                self.connection = self.connect()
+            db = self.connection
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute(f"SELECT tokens, updated FROM {self.table} WHERE key = ?", (key,)).fetchone()
+                tokens = float(self.burst) if row is None else min(self.burst, row[0] + max(0.0, now - row[1]) * self.rate)
+                allowed = tokens >= 1
+                if allowed:
+                    tokens -= 1
+                db.execute(f"INSERT OR REPLACE INTO {self.table} (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+                self.takes += 1
+                if self.takes % self.EVICT_EVERY == 0:
+                    db.execute(f"DELETE FROM {self.table} WHERE updated < ?", (now - self.idle_after,))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return 0.0 if allowed else (1 - tokens) / self.rate
+
+    async def take(self, key: str) -> float:
+        return await asyncio.to_thread(self.take_sync, key)
+
+    def __len__(self) -> int:
+        return 0 # Shared between workers, not counted here
+
+
+class RateLimiter:
+    def __init__(self, scope: str, rate: float, burst: int, store_spec: str):
+        self.scope = scope
+        self.store = None
+        if rate <= 0 or burst <= 0:
+            return
+        if store_spec.startswith("sqlite:"):
+            self.store = SQLiteBucketStore(store_spec[len("sqlite:"):], f"buckets_{scope}", rate, burst)
+        else:
+            if store_spec != "memory":
+                print(f"Unknown RATE_LIMIT_STORE {store_spec!r}, using memory")
+            self.store = MemoryBucketStore(rate, burst, RATE_LIMIT_MAX_KEYS)
+
+    async def check(self, key: str):
+        if self.store is None:
+            return
+        try:
+            retry_after = await self.store.take(key)
+        except sqlite3.Error as e:
+            # A broken shared store lets traffic through rather than taking the chat down
+            print(f"Rate limit store for {self.scope} failed: {e}")
+            return
+        if retry_after > 0:
+            RATE_LIMITED.inc(self.scope)
+            raise RateLimited(retry_after, self.scope)
+
+    def stats(self) -> Dict:
+        return {"enabled": self.store is not None, "keys": len(self.store) if self.store is not None else 0}
+
+
+ip_limiter = RateLimiter("ip", RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST, RATE_LIMIT_STORE)
+sender_limiter = RateLimiter("sender", RATE_LIMIT_SENDER_RATE, RATE_LIMIT_SENDER_BURST, RATE_LIMIT_STORE)
+
+
+async def check_rate_limits(sender_id: str, client_ip: Optional[str]):
+    """
+    Raises RateLimited when the client or the sender is over its limit. The
+    IP goes first, so a client rotating sender ids can't get past it.
+    """
+    if client_ip:
+        await ip_limiter.check(client_ip)
+    await sender_limiter.check(sender_id)
+
+
+def rate_limited_response(error: RateLimited) -> Response:
+    return json_response(
+        {"responses": [{"text": RATE_LIMITED_MESSAGE}]},
+        status_code=429,
+        headers={"Retry-After": str(math.ceil(error.retry_after))},
+    )
+
+
+# --- Response cache ---
+def normalize_message(message: str) -> str:
+    """Folds case, punctuation and whitespace so "Pricing?" and " pricing " share a key."""
+    message = re.sub(r"[^\w\s]", " ", message.lower())
+    return " ".join(message.split())
+
+
+def compile_patterns(patterns: str) -> List[re.Pattern]:
+    return [re.compile(p.strip()) for p in patterns.split(",") if p.strip()]
+
+
+class ResponseCache:
+    """
+    In-process LRU cache of Rasa responses keyed on the normalized message.
+    Expired entries are kept until they are evicted so they can still be
+    served while Rasa is erroring.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, stale_ttl: float, allow: str, deny: str):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.allow = compile_patterns(allow)
+        self.deny = compile_patterns(deny)
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+
+    def is_cacheable(self, key: str) -> bool:
+        if self.max_entries <= 0 or not key:
+            return False
+        if any(p.fullmatch(key) for p in self.deny):
+            return False
+        return any(p.fullmatch(key) for p in self.allow)
+
+    def get(self, key: str) -> Optional[list]:
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def get_stale(self, key: str) -> Optional[list]:
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.stale_ttl:
+            return None
+        self.stale_hits += 1
+        return entry[1]
+
+    def set(self, key: str, responses: list):
+        self.entries[key] = (time.monotonic(), responses)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+
+def for_sender(responses: list, sender_id: str) -> list:
+    # Cached answers were produced for another sender, point them at this one
+    return [dict(r, recipient_id=sender_id) if "recipient_id" in r else r for r in responses]
+
+
+# --- Fast path ---
+class PhraseMatcher:
+    """
+    Aho-Corasick automaton over word sequences: finds every configured phrase
+    in a message in one pass, however many phrases there are.
+    """
+
+    def __init__(self):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # node -> [(phrase length in words, value)] of the phrases ending there
+        self.output: List[List[Tuple[int, object]]] = [[]]
+
+    def add(self, words: List[str], value):
+        node = 0
+        for word in words:
+            if word not in self.goto[node]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[node][word] = len(self.goto) - 1
+            node = self.goto[node][word]
+        self.output[node].append((len(words), value))
+
+    def build(self):
+        """Computes the failure links, call once after the last add()."""
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for word, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and word not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(word, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, words: List[str]) -> List[Tuple[int, int, object]]:
+        """Every match as (first word index, end word index, value)."""
+        matches = []
+        node = 0
+        for end, word in enumerate(words, 1):
+            while node and word not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(word, 0)
+            for length, value in self.output[node]:
+                matches.append((end - length, end, value))
+        return matches
+
+
+class FastPathEntry:
+    def __init__(self, config: Dict):
+        self.name = config["name"]
+        self.responses = config["responses"]
+        self.min_confidence = float(config.get("min_confidence", FAST_PATH_MIN_CONFIDENCE))
+        # Replay the message to Rasa afterwards so its tracker sees the turn too
+        self.notify = bool(config.get("notify", False))
+
+
+class FastPath:
+    """
+    Answers messages made (almost) entirely of the phrases of one entry of
+    the config file, e.g. {"ignore": ["please"], "answers": [{"name":
+    "greet", "phrases": ["hi", "hello"], "responses": [{"text": "Hi!"}]}]}.
+    Confidence is the share of the message's words (minus ignored ones)
+    covered by the entry's phrases.
+    """
+
+    def __init__(self, path: str, bot: str):
+        self.bot = bot
+        self.entries: List[FastPathEntry] = []
+        self.ignore: set = set()
+        self.matcher = PhraseMatcher()
+        # Replays to Rasa still running, referenced so they aren't garbage collected
+        self.notifications: set = set()
+        if path:
+            try:
+                self.load(path)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"Fast path disabled, could not load {path}: {e!r}")
+                self.entries = []
+                self.matcher = PhraseMatcher()
+
+    def load(self, path: str):
+        with open(path, "rb") as f:
+            config = loads(f.read())
+        self.ignore = {normalize_message(word) for word in config.get("ignore", [])}
+        seen = {}
+        for index, answer in enumerate(config["answers"]):
+            entry = FastPathEntry(answer)
+            self.entries.append(entry)
+            for phrase in answer["phrases"]:
+                words = self.words(phrase)
+                if not words:
+                    continue
+                if tuple(words) in seen:
+                    print(f"Fast path phrase {phrase!r} of {entry.name!r} is already used by {seen[tuple(words)]!r}")
+                    continue
+                seen[tuple(words)] = entry.name
+                self.matcher.add(words, index)
+        self.matcher.build()
+        print(f"Fast path loaded {len(seen)} phrases for {len(self.entries)} answers from {path}")
+
+    def words(self, text: str) -> List[str]:
+        return [word for word in normalize_message(text).split() if word not in self.ignore]
+
+    def match(self, message: str) -> Optional[FastPathEntry]:
+        if not self.entries:
+            return None
+        # Button payloads ("/intent{...}") are meant for Rasa
+        if message.lstrip().startswith("/"):
+            FAST_PATH_LOOKUPS.inc(self.bot, "skipped")
+            return None
+        words = self.words(message)
+        covered: Dict[int, set] = {}
+        for start, end, index in self.matcher.find(words):
+            covered.setdefault(index, set()).update(range(start, end))
+        if not covered:
+            FAST_PATH_LOOKUPS.inc(self.bot, "miss")
+            return None
+
+        # Most words covered wins, the entry listed first on a tie
+        index = max(covered, key=lambda i: (len(covered[i]), -i))
+        entry = self.entries[index]
+        if len(covered[index]) / len(words) < entry.min_confidence:
+            FAST_PATH_LOOKUPS.inc(self.bot, "low_confidence")
+            return None
+        FAST_PATH_LOOKUPS.inc(self.bot, "hit")
+        FAST_PATH_ANSWERS.inc(self.bot, entry.name)
+        return entry
+
+    def answer(self, sender_id: str, message: str) -> Optional[list]:
+        entry = self.match(message)
+        if entry is None:
+            return None
+        if entry.notify:
+            task = asyncio.ensure_future(notify_rasa(sender_id, message))
+            self.notifications.add(task)
+            task.add_done_callback(self.notifications.discard)
+        return [dict(r, recipient_id=sender_id) for r in entry.responses]
+
+    def stats(self) -> Dict:
+        lookups = {result: int(FAST_PATH_LOOKUPS.values.get((self.bot, result), 0)) for result in ("hit", "miss", "low_confidence")}
+        total = sum(lookups.values())
+        return {
+            "enabled": bool(self.entries),
+            **lookups,
+            "hit_ratio": lookups["hit"] / total if total else 0.0,
+            "notifications_pending": len(self.notifications),
+        }
+
+
+async def notify_rasa(sender_id: str, message: str):
+    """
+    Replays a fast path turn to Rasa and throws its answer away. It queues
+    behind the sender's turn like any other turn, so the sender's next
+    message reaches Rasa after it and the tracker stays in order.
+    """
+    async def replay():
+        await forward_to_rasa_raw(sender_id, message)
+        return []
+
+    # Runs after the turn was answered, its timings belong to no request
+    turn_timing.set(None)
+    bot = current_tenant.get().name
+
+    try:
+        # The prefix keeps it from being coalesced with a real turn of the same message
+        await sender_queues.run(current_tenant.get().sender_key(sender_id), "\0notify:" + message, replay)
+        FAST_PATH_NOTIFICATIONS.inc(bot, "sent")
+    except UpstreamOverloaded:
+        FAST_PATH_NOTIFICATIONS.inc(bot, "overloaded")
+    except Exception as e:
+        FAST_PATH_NOTIFICATIONS.inc(bot, "failed")
+        print(f"Could not replay fast path turn of {sender_id} to Rasa: {e!r}")
+
+
+# --- Tenants ---
+class Tenant:
+    """
+    One bot: its Rasa servers, connection pool, admission control, timeouts,
+    response cache and fast path. Nothing is shared with the other bots, so
+    a slow one only ever uses up its own slots and connections. Settings
+    missing from its config fall back to the RASA_* / CHAT_CACHE_* variables.
+    """
+
+    def __init__(self, name: str, config: Dict):
+        self.name = name
+        self.config = config
+        self.hosts = [host.lower() for host in config.get("hosts", [])]
+        self.backends = RasaBackends([url.strip().rstrip("/") for url in config["urls"]])
+        self.admission = AdmissionController(
+            limit=int(config.get("max_concurrency", RASA_MAX_CONCURRENCY)),
+            queue_size=int(config.get("queue_size", RASA_QUEUE_SIZE)),
+            queue_timeout=float(config.get("queue_timeout", RASA_QUEUE_TIMEOUT)),
+            adaptive=bool(config.get("adaptive_concurrency", RASA_ADAPTIVE_CONCURRENCY)),
+        )
+        self.max_connections = int(config.get("max_connections", RASA_MAX_CONNECTIONS))
+        self.timeout = httpx.Timeout(
+            connect=float(config.get("connect_timeout", RASA_CONNECT_TIMEOUT)),
+            read=float(config.get("read_timeout", RASA_READ_TIMEOUT)),
+            write=float(config.get("write_timeout", RASA_WRITE_TIMEOUT)),
+            pool=float(config.get("pool_timeout", RASA_POOL_TIMEOUT)),
+        )
+        self.cache = ResponseCache(
+            max_entries=int(config.get("cache_max_entries", CHAT_CACHE_MAX_ENTRIES)),
+            ttl=float(config.get("cache_ttl", CHAT_CACHE_TTL)),
+            stale_ttl=CHAT_CACHE_STALE_TTL,
+            allow=config.get("cache_allow", CHAT_CACHE_ALLOW),
+            deny=config.get("cache_deny", CHAT_CACHE_DENY),
+        )
+        self.fast_path = FastPath(config.get("fast_path_file", ""), name)
+        self.shadow_url = config.get("shadow_url", "").strip().rstrip("/")
+        self.client: Optional[httpx.AsyncClient] = None
+        self.monitor: Optional[asyncio.Task] = None
+
+    def sender_key(self, sender_id: str) -> str:
+        """Key of the sender's turn queue, the same sender id may talk to several bots."""
+        return sender_id if self.name == DEFAULT_TENANT else f"{self.name}\0{sender_id}"
+
+    async def start(self):
+        """Opens the pool and takes a first reading of every Rasa server before the bot gets traffic."""
+        self.client = create_http_client(self.max_connections, self.timeout)
+        await asyncio.gather(
+            warm_up_http_client(self.client, self.backends.backends),
+            self.backends.probe_all(self.client),
+        )
+        self.monitor = asyncio.create_task(self.backends.monitor(self.client))
+
+    async def stop(self):
+        if self.monitor is not None:
+            self.monitor.cancel()
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def retire(self, grace: float = 60.0):
+        """Stops the bot once the requests still using it are done (or after grace seconds)."""
+        deadline = time.monotonic() + grace
+        while time.monotonic() < deadline:
+            stats = self.admission.stats()
+            if not stats["in_flight"] and not stats["queued"]:
+                break
+            await asyncio.sleep(0.5)
+        await self.stop()
+
+    def stats(self) -> Dict:
+        return {
+            "cache": self.cache.stats(),
+            "fast_path": self.fast_path.stats(),
+            "admission": self.admission.stats(),
+        }
+
+
+DEFAULT_TENANT = "default"
+TENANT_NAME = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+class Tenants:
+    """
+    The bots this deployment serves: the default one from the environment
+    and the ones in TENANTS_FILE. Reloading the file starts added and
+    changed bots before they get traffic, keeps unchanged ones (with their
+    pools and breaker state) and retires the rest once they are idle.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.default = Tenant(
+            DEFAULT_TENANT, {"urls": RASA_SERVER_URLS, "fast_path_file": FAST_PATH_FILE, "shadow_url": SHADOW_RASA_URL}
+        )
+        self.tenants: Dict[str, Tenant] = {DEFAULT_TENANT: self.default}
+        self.hosts: Dict[str, Tenant] = {}
+        self.mtime = 0.0
+        self.reloads = 0
+        self.watcher: Optional[asyncio.Task] = None
+
+    def get(self, name: str) -> Optional[Tenant]:
+        return self.tenants.get(name)
+
+    def for_host(self, host: str) -> Optional[Tenant]:
+        return self.hosts.get(host.rsplit(":", 1)[0].lower()) if self.hosts else None
+
+    def read(self) -> Dict[str, Dict]:
+        with open(self.path, "rb") as f:
+            configs = loads(f.read()).get("tenants", {})
+        for name, config in configs.items():
+            if name == DEFAULT_TENANT or not TENANT_NAME.fullmatch(name):
+                raise ValueError(f"invalid bot name {name!r}")
+            if not config.get("urls"):
+                raise ValueError(f"bot {name!r} has no urls")
+        return configs
+
+    async def load(self):
+        """(Re)reads TENANTS_FILE. A broken file is logged and the bots stay as they were."""
+        try:
+            self.mtime = os.stat(self.path).st_mtime
+            configs = await asyncio.to_thread(self.read)
+            tenants = {DEFAULT_TENANT: self.default}
+            started = []
+            for name, config in configs.items():
+                current = self.tenants.get(name)
+                if current is not None and current.config == config:
+                    tenants[name] = current
+                else:
+                    tenants[name] = Tenant(name, config)
+                    started.append(tenants[name])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, re.error) as e:
+            print(f"Could not load bots from {self.path}: {e!r}")
+            return
+
+        await asyncio.gather(*(tenant.start() for tenant in started))
+        retired = [t for name, t in self.tenants.items() if tenants.get(name) is not t]
+        self.tenants = tenants
+        self.hosts = {host: tenant for tenant in tenants.values() for host in tenant.hosts}
+        self.reloads += 1
+        for tenant in retired:
+            asyncio.create_task(tenant.retire())
+        print(f"Serving bots: {', '.join(tenants)}")
+
+    async def watch(self):
+        """Background task: reloads TENANTS_FILE whenever its modification time changes."""
+        while True:
+            await asyncio.sleep(TENANTS_RELOAD_INTERVAL)
+            try:
+                changed = os.stat(self.path).st_mtime != self.mtime
+            except OSError:
+                changed = False
+            if changed:
+                try:
+                    await self.load()
+                except Exception as e:
+                    # Keep watching, the next edit of the file may fix it
+                    print(f"Reloading bots from {self.path} failed: {e!r}")
+
+    async def start(self):
+        await self.default.start()
+        if self.path:
+            await self.load()
+            self.watcher = asyncio.create_task(self.watch())
+
+    async def stop(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+        await asyncio.gather(*(tenant.stop() for tenant in self.tenants.values()))
+
+    def readiness(self) -> Optional[str]:
+        """Ready while any bot can answer, one bot being down shouldn't take the others off."""
+        reasons = {name: tenant.backends.readiness() for name, tenant in self.tenants.items()}
+        if any(reason is None for reason in reasons.values()):
+            return None
+        return "; ".join(f"{name}: {reason}" for name, reason in reasons.items())
+
+
+tenants = Tenants(TENANTS_FILE)
+# The bot of the request or turn being handled
+current_tenant: ContextVar[Tenant] = ContextVar("current_tenant", default=tenants.default)
+
+
+def resolve_tenant(bot: Optional[str]) -> Tenant:
+    """The bot named in a request body, or the one its path or host picked. Unknown names are a 404."""
+    if bot is None:
+        return current_tenant.get()
+    tenant = tenants.get(bot)
+    if tenant is None:
+        raise HTTPException(status_code=404, detail=f"Unknown bot {bot!r}")
+    current_tenant.set(tenant)
+    return tenant
+
+
+# --- Per-sender ordering ---
+class SenderState:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # Turns queued or in flight
+        self.pending = 0
+        # The most recently submitted turn while it's unanswered: its message and
+        # an awaitable resolving to its responses
+        self.tail_message: Optional[str] = None
+        self.tail: Optional[Awaitable] = None
+
+
+class SenderQueues:
+    """
+    Runs the turns of one sender one at a time, in arrival order, while
+    different senders run fully concurrently. A message identical to the
+    sender's most recently submitted turn, while that turn is still queued or
+    in flight (Enter spam, retries), shares its result instead of reaching
+    Rasa again; once a different message came in between, it is a turn of its
+    own ("yes", "no", "yes"). A sender's entry is dropped as soon as it has
+    nothing queued or in flight, so memory only grows with the number of
+    active senders.
+    """
+
+    def __init__(self):
+        self.senders: Dict[str, SenderState] = {}
+        self.coalesced = 0
+
+    def state(self, sender_id: str) -> SenderState:
+        state = self.senders.get(sender_id)
+        if state is None:
+            state = self.senders[sender_id] = SenderState()
+        return state
+
+    def shared_turn(self, state: SenderState, message: str) -> Optional[Awaitable]:
+        """The turn a message can share: the sender's last one, if it's the same message and unanswered."""
+        if state.tail is not None and state.tail_message == message:
+            self.coalesced += 1
+            return state.tail
+        return None
+
+    def enqueue(self, state: SenderState, message: str, turn: Awaitable):
+        state.pending += 1
+        state.tail_message = message
+        state.tail = turn
+
+    def release(self, sender_id: str, state: SenderState, turn: Awaitable):
+        state.pending -= 1
+        if state.tail is turn:
+            state.tail_message = state.tail = None
+        if not state.pending and self.senders.get(sender_id) is state:
+            del self.senders[sender_id]
+
+    async def run(self, sender_id: str, message: str, turn: Callable[[], Awaitable[list]]) -> list:
+        state = self.state(sender_id)
+        shared = self.shared_turn(state, message)
+        if shared is not None:
+            return await asyncio.shield(shared)
+
+        async def serialized():
+            try:
+                async with state.lock:
+                    return await turn()
+            finally:
+                self.release(sender_id, state, task)
+
+        # A task so the turn still completes for the coalesced callers if this caller goes away
+        task = asyncio.ensure_future(serialized())
+        self.enqueue(state, message, task)
+        return await asyncio.shield(task)
+
+    async def stream(self, sender_id: str, message: str, turn: Callable[[], AsyncIterator[Dict]]) -> AsyncIterator[Dict]:
+        """Streaming counterpart of run(); coalesced callers get all items once the turn is done."""
+        state = self.state(sender_id)
+        shared = self.shared_turn(state, message)
+        if shared is not None:
+            result = await asyncio.shield(shared)
+            # A turn started by run() may have finished with the raw bytes of Rasa's answer
+            for item in loads(result) if isinstance(result, bytes) else result:
+                yield item
+            return
+
+        done = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting on it, don't let an unretrieved exception get logged
+        done.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.enqueue(state, message, done)
+        received = []
+        try:
+            async with state.lock:
+                async for item in turn():
+                    received.append(item)
+                    yield item
+        except Exception as e:
+            done.set_exception(e)
+            raise
+        finally:
+            if not done.done():
+                done.set_result(received)
+            self.release(sender_id, state, done)
+
+    def stats(self) -> Dict:
+        return {"active_senders": len(self.senders), "coalesced": self.coalesced}
+
+
+sender_queues = SenderQueues()
+
+
+# --- Transcripts ---
+class TranscriptWriter:
+    """
+    Write-behind store of every answered turn. record() only appends to a
+    bounded queue and never waits; a background task takes batches off the
+    queue and inserts them from a worker thread, so the disk never sits on
+    the response path. Several worker processes can share the file (WAL mode).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=TRANSCRIPT_QUEUE_SIZE)
+        self.batch_ready = asyncio.Event()
+        self.closing = False
+        self.task: Optional[asyncio.Task] = None
+        self.connection: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def record(self, sender_id: str, message: str, responses):
+        """Queues one turn of the current bot; responses is a list or the raw bytes of Rasa's JSON array."""
+        if not self.enabled or self.closing:
+            return
+        try:
+            self.queue.put_nowait((current_tenant.get().name, sender_id, time.time(), message, responses))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        self.recorded += 1
+        if self.queue.qsize() >= TRANSCRIPT_BATCH_SIZE:
+            self.batch_ready.set()
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=10.0, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS transcripts ("
+            "id INTEGER PRIMARY KEY, sender_id TEXT NOT NULL, created_at REAL NOT NULL, "
+            "message TEXT NOT NULL, responses TEXT NOT NULL, bot TEXT NOT NULL DEFAULT 'default')"
+        )
+        # Files written before there were several bots
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(transcripts)")]
+        if "bot" not in columns:
+            connection.execute("ALTER TABLE transcripts ADD COLUMN bot TEXT NOT NULL DEFAULT 'default'")
+        connection.execute("CREATE INDEX IF NOT EXISTS transcripts_sender ON transcripts (sender_id, id)")
+        connection.commit()
+        return connection
+
+    def write(self, batch: List[tuple]):
+        """Runs in a worker thread."""
+        rows = [
+            (bot, sender_id, created_at, message, responses.decode("utf-8") if isinstance(responses, bytes) else dumps(responses))
+            for bot, sender_id, created_at, message, responses in batch
+        ]
+        with self.lock:
+            if self.connection is None:
+                self.connection = self.connect()
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT INTO transcripts (bot, sender_id, created_at, message, responses) VALUES (?, ?, ?, ?, ?)", rows
+                )
+
+    async def flush(self, batch: List[tuple]):
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(self.write, batch)
+            self.written += len(batch)
+        except (sqlite3.Error, OSError) as e:
+            self.failed += len(batch)
+            print(f"Could not write {len(batch)} transcript entries: {e}")
+        TRANSCRIPT_FLUSH_SECONDS.observe(time.perf_counter() - start)
+
+    async def run(self):
+        """Background task: flushes whenever a batch is full or the flush interval passed."""
+        while not (self.closing and self.queue.empty()):
+            if self.queue.qsize() < TRANSCRIPT_BATCH_SIZE and not self.closing:
+                self.batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self.batch_ready.wait(), TRANSCRIPT_FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            batch = [self.queue.get_nowait() for _ in range(min(self.queue.qsize(), TRANSCRIPT_BATCH_SIZE))]
+            if batch:
+                await self.flush(batch)
+
+    def start(self):
+        if self.enabled:
+            self.closing = False
+            self.batch_ready = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        """Writes out whatever is still queued and closes the database."""
+        if self.task is None:
+            return
+        self.closing = True
+        self.batch_ready.set()
+        await self.task
+        self.task = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def history(self, bot: str, sender_id: str, limit: int, before: Optional[int]) -> List[Dict]:
+        """A sender's turns, newest first. Runs in a worker thread, turns still queued aren't included."""
+        if not os.path.exists(self.path):
+            return []
+        connection = sqlite3.connect(self.path, timeout=10.0)
+        try:
+            rows = connection.execute(
+                "SELECT id, created_at, message, responses FROM transcripts "
+                "WHERE sender_id = ? AND bot = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (sender_id, bot, before if before is not None else 2 ** 63 - 1, limit),
+            ).fetchall()
+        finally:
+            connection.close()
+        return [
+            {"id": row_id, "timestamp": created_at, "message": message, "responses": loads(responses)}
+            for row_id, created_at, message, responses in rows
+        ]
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "queued": self.queue.qsize(),
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed,
+        }
+
+
+transcripts = TranscriptWriter(TRANSCRIPT_DB)
+
+
+# --- Shadow traffic ---
+def latency_summary(seconds: List[float]) -> Dict:
+    """Percentiles in milliseconds, empty without samples."""
+    if not seconds:
+        return {}
+    ordered = sorted(seconds)
+
+    def at(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 1)
+
+    return {"count": len(ordered), "p50": at(0.50), "p95": at(0.95), "p99": at(0.99), "max": at(1.0)}
+
+
+def comparable_responses(responses: list) -> list:
+    """Rasa's answer without the parts that always differ between two senders."""
+    return [
+        {key: value for key, value in item.items() if key != "recipient_id"} if isinstance(item, dict) else item
+        for item in responses
+    ]
+
+
+class ShadowStats:
+    """What the shadow server did with one bot's mirrored turns."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.mirrored = 0
+        self.dropped = 0
+        self.failed = 0
+        self.matched = 0
+        self.differed = 0
+        self.last_error: Optional[str] = None
+        # (primary seconds or None when the answer didn't come from Rasa, shadow seconds)
+        self.latencies: deque = deque(maxlen=SHADOW_LATENCY_SAMPLES)
+        self.differences: deque = deque(maxlen=SHADOW_REPORT_EXAMPLES)
+
+    def report(self) -> Dict:
+        paired = [(primary, shadow) for primary, shadow in self.latencies if primary is not None]
+        compared = self.matched + self.differed
+        return {
+            "url": self.url,
+            "mirrored": self.mirrored,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "matched": self.matched,
+            "differed": self.differed,
+            "diff_ratio": round(self.differed / compared, 4) if compared else 0.0,
+            "last_error": self.last_error,
+            "primary_ms": latency_summary([primary for primary, _ in paired]),
+            "shadow_ms": latency_summary([shadow for _, shadow in self.latencies]),
+            # Shadow minus primary for the same turn, positive when the candidate is slower
+            "delta_ms": latency_summary([shadow - primary for primary, shadow in paired]),
+            "differences": list(self.differences),
+        }
+
+
+class ShadowMirror:
+    """
+    Replays sampled turns to a candidate Rasa server and compares the
+    answers and latencies with the ones the user got. mirror() only appends
+    to a bounded queue, so the primary response never waits on the shadow;
+    a few workers replay the queues over their own connection pool. Senders
+    are sampled as a whole and each sender always goes to the same worker,
+    so the shadow tracker sees complete conversations in their real order.
+    """
+
+    def __init__(self):
+        self.queues: List[asyncio.Queue] = []
+        self.client: Optional[httpx.AsyncClient] = None
+        self.workers: List[asyncio.Task] = []
+        self.reporter: Optional[asyncio.Task] = None
+        self.bots: Dict[str, ShadowStats] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return SHADOW_SAMPLE_RATE > 0 and SHADOW_CONCURRENCY > 0
+
+    def sampled(self, sender_id: str) -> bool:
+        return ring_hash("shadow\0" + sender_id) < SHADOW_SAMPLE_RATE * 2 ** 64
+
+    def mirror(self, sender_id: str, message: str, responses, primary_seconds: Optional[float]):
+        """Queues one answered turn of the current bot; responses is a list or the raw bytes of Rasa's JSON array."""
+        tenant = current_tenant.get()
+        if not (self.workers and tenant.shadow_url and self.sampled(sender_id)):
+            return
+        stats = self.bots.get(tenant.name)
+        if stats is None or stats.url != tenant.shadow_url:
+            stats = self.bots[tenant.name] = ShadowStats(tenant.shadow_url)
+        queue = self.queues[ring_hash(tenant.sender_key(sender_id)) % len(self.queues)]
+        try:
+            queue.put_nowait((stats, sender_id, message, responses, primary_seconds))
+        except asyncio.QueueFull:
+            stats.dropped += 1
+
+    async def replay(self, stats: ShadowStats, sender_id: str, message: str, responses, primary_seconds: Optional[float]):
+        start = time.perf_counter()
+        try:
+            shadow_response = await self.client.post(
+                f"{stats.url}/webhooks/rest/webhook",
+                content=dumps(rasa_payload(SHADOW_SENDER_PREFIX + sender_id, message)),
+                headers={"Content-Type": "application/json"},
+            )
+            shadow_response.raise_for_status()
+            shadow_responses = loads(shadow_response.content)
+        except Exception as e:
+            stats.failed += 1
+            stats.last_error = repr(e)
+            return
+        stats.mirrored += 1
+        stats.latencies.append((primary_seconds, time.perf_counter() - start))
+
+        primary = loads(responses) if isinstance(responses, bytes) else responses
+        if comparable_responses(primary) == comparable_responses(shadow_responses):
+            stats.matched += 1
+        else:
+            stats.differed += 1
+            stats.differences.append({"message": message, "primary": primary, "shadow": shadow_responses})
+
+    async def work(self, queue: asyncio.Queue):
+        """One worker per queue, so a sender's turns are replayed one at a time and in order."""
+        while True:
+            await self.replay(*await queue.get())
+
+    @property
+    def queued(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    def report(self) -> Dict:
+        return {
+            "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "pid": os.getpid(),
+            "sample_rate": SHADOW_SAMPLE_RATE,
+            "queued": self.queued,
+            "bots": {bot: stats.report() for bot, stats in self.bots.items()},
+        }
+
+    def write_report(self, report: Dict):
+        """Runs in a worker thread. Replaces the file in one step, readers never see half a report."""
+        os.makedirs(SHADOW_REPORT_DIR, exist_ok=True)
+        # Named when written, not at import: preloaded workers are forked from one process
+        path = os.path.join(SHADOW_REPORT_DIR, f"shadow-{os.getpid()}.json")
+        temporary = path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(json.dumps(report, indent=2))
+        os.replace(temporary, path)
+
+    async def save(self):
+        if not self.bots:
+            return
+        try:
+            await asyncio.to_thread(self.write_report, self.report())
+        except OSError as e:
+            print(f"Could not write the shadow traffic report: {e}")
+
+    async def report_periodically(self):
+        while True:
+            await asyncio.sleep(SHADOW_REPORT_INTERVAL)
+            await self.save()
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.queues = [
+            asyncio.Queue(maxsize=max(1, SHADOW_QUEUE_SIZE // SHADOW_CONCURRENCY)) for _ in range(SHADOW_CONCURRENCY)
+        ]
+        self.client = create_http_client(
+            SHADOW_CONCURRENCY, httpx.Timeout(SHADOW_TIMEOUT, connect=RASA_CONNECT_TIMEOUT)
+        )
+        self.workers = [asyncio.create_task(self.work(queue)) for queue in self.queues]
+        self.reporter = asyncio.create_task(self.report_periodically())
+
+    async def stop(self):
+        """Drops the turns still queued, nobody waits on them, and writes a last report."""
+        if not self.workers:
+            return
+        for task in self.workers + [self.reporter]:
+            task.cancel()
+        self.workers = []
+        await self.save()
+        await self.client.aclose()
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "queued": self.queued,
+            "bots": {
+                bot: {key: getattr(stats, key) for key in ("url", "mirrored", "dropped", "failed", "matched", "differed")}
+                for bot, stats in self.bots.items()
+            },
+        }
+
+
+shadow = ShadowMirror()
+
+
+# Set once startup warmup is done, cleared when shutdown begins
+app_ready = False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global app_ready
+    # Fill the pools, take a first reading of every Rasa server and run the
+    # page and asset routes once before /health/ready lets traffic in
+    await asyncio.gather(tenants.start(), warm_up_frontend(app))
+    transcripts.start()
+    shadow.start()
+    chat_jobs.start()
+    app_ready = True
+    try:
+        yield
+    finally:
+        app_ready = False
+        chat_jobs.stop()
+        await shadow.stop()
+        await transcripts.close()
+        await tenants.stop()
+
+
+# --- Profiling ---
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of one thread (the event loop's) at a fixed interval
+    and counts identical stacks. Everything the loop runs meanwhile shows
+    up, not only the profiled request, and time spent waiting on Rasa shows
+    as the loop idling in its selector.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Dict[str, int] = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                stack = ";".join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self) -> str:
+        """Stops sampling and returns the profile in collapsed format ("frame;frame;frame count" lines)."""
+        self.stopped.set()
+        self.join()
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+
+# One profile at a time per worker, the sampler's overhead shouldn't pile up
+profiler_busy = False
+
+
+def wants_profile(scope: Dict) -> bool:
+    if profiler_busy or scope["path"] != "/chat":
+        return False
+    if PROFILE_SECRET:
+        header = dict(scope["headers"]).get(b"x-profile", b"")
+        if header and hmac.compare_digest(header, PROFILE_SECRET.encode()):
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def write_profile(name: str, profile: str):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, name), "w") as f:
+        f.write(profile)
+
+
+class RequestTiming:
+    """
+    ASGI middleware: stamps when each request arrived (for the parse phase
+    of Server-Timing) and profiles the requests chosen by wants_profile().
+    A profiled response carries the profile's file name in X-Profile.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        scope.setdefault("state", {})["received_at"] = time.perf_counter()
+        if not wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        global profiler_busy
+        profiler_busy = True
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{random.getrandbits(32):08x}.folded"
+        sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL)
+
+        async def send_with_name(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile", name.encode())]
+            await send(message)
+
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_name)
+        finally:
+            profile = sampler.stop()
+            profiler_busy = False
+            try:
+                await asyncio.to_thread(write_profile, name, profile)
+            except OSError as e:
+                print(f"Could not write profile {name}: {e}")
+
+
+class TenantRouting:
+    """
+    ASGI middleware: picks the bot of each request from a /bots/<name>/ path
+    prefix (which is stripped, so the usual routes answer underneath it) or
+    from the Host header, and makes it the current tenant.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        tenant = None
+        if path.startswith("/bots/"):
+            name, slash, rest = path[len("/bots/"):].partition("/")
+            tenant = tenants.get(name)
+            if tenant is not None:
+                if not slash and scope["type"] == "http":
+                    # The page's relative URLs need the trailing slash
+                    await RedirectResponse(f"{scope.get('root_path', '')}{path}/")(scope, receive, send)
+                    return
+                prefix = f"/bots/{name}"
+                scope = dict(scope, path="/" + rest, root_path=scope.get("root_path", "") + prefix)
+        if tenant is None:
+            host = dict(scope["headers"]).get(b"host", b"").decode("latin-1")
+            tenant = tenants.for_host(host) if host else None
+        if tenant is not None:
+            current_tenant.set(tenant)
+        await self.app(scope, receive, send)
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Allow cross-origin requests
 app.add_middleware(
@@ -26,632 +2022,1217 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Chat-Mode"],
 )
+app.add_middleware(RequestTiming)
+app.add_middleware(TenantRouting)
 
 
 # --- Frontend UI ---
-@app.get("/", response_class=HTMLResponse)
-def home():
-    # The HTML and CSS are identical to your original code to preserve the design.
-    # The JavaScript has been modified for Rasa integration.
-    return """
-    <!DOCTYPE html>
-    <html>
-      <head>
-        <meta charset="utf-8" />
-        <title>Vasp Assistant</title>
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <style>
-          * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-          }
-          
-          body { 
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
-            background: #f4f4f4;
-            height: 100vh;
-            overflow: hidden;
-          }
-          
-          .chat-container {
-            width: 100%;
-            height: 100vh;
-            background: #ffffff;
-            display: flex;
-            flex-direction: column;
-            position: relative;
-          }
-          
-          .chat-content {
-            flex: 1;
-            display: flex;
-            flex-direction: column;
-            overflow: hidden;
-          }
-          
-          .chat-messages {
-            flex: 1;
-            padding: 24px;
-            overflow-y: auto;
-            background: #ffffff;
-          }
-          
-          .message-wrapper {
-            margin-bottom: 24px;
-            animation: fadeIn 0.3s ease-in;
-          }
-          
-          .user-message-wrapper {
-            margin-bottom: 24px;
-            text-align: right;
-            animation: fadeIn 0.3s ease-in;
-          }
-          
-          .message-header {
-            display: flex;
-            align-items: center;
-            margin-bottom: 12px;
-          }
-          
-          .bot-avatar {
-            width: 32px;
-            height: 32px;
-            border-radius: 0%;
-            background: url("/assets/vasptech.png") no-repeat center center;
-            background-size: cover;
-            margin-right: 12px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            position: relative;
-          }
-          
-          .user-avatar {
-            width: 32px;
-            height: 32px;
-            border-radius: 50%;
-            background: linear-gradient(135deg, #34a853 0%, #137333 100%);
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            margin-left: 12px;
-            position: relative;
-          }
-          
-          .user-avatar::before {
-            content: '👤';
-            font-size: 16px;
-            filter: brightness(0) invert(1);
-          }
-          
-          .user-message-header {
-            display: flex;
-            align-items: center;
-            justify-content: flex-end;
-            margin-bottom: 12px;
-          }
-          
-          .message-info {
-            display: flex;
-            align-items: center;
-            gap: 8px;
-          }
-          
-          .user-message-info {
-            display: flex;
-            align-items: center;
-            gap: 8px;
-            flex-direction: row-reverse;
-          }
-          
-          .bot-name, .user-name {
-            font-weight: 600;
-            color: #161616;
-            font-size: 14px;
-          }
-          
-          .timestamp {
-            color: #6f6f6f;
-            font-size: 14px;
-          }
-          
-          .message-content {
-            color: #161616;
-            font-size: 14px;
-            line-height: 1.5;
-            margin-bottom: 20px;
-            white-space: pre-line;
-          }
-          
-          .user-message-content {
-            background: #e3f2fd;
-            color: #161616;
-            font-size: 14px;
-            line-height: 1.5;
-            padding: 12px 16px;
-            border-radius: 18px;
-            border-bottom-right-radius: 4px;
-            display: inline-block;
-            max-width: 80%;
-            text-align: left;
-          }
-          
-          .options-container {
-            display: flex;
-            flex-direction: column;
-            gap: 8px;
-            margin-top: 16px;
-          }
-          
-          .option-button {
-            background: #f4f4f4;
-            border: 1px solid #e0e0e0;
-            color: #161616;
-            padding: 16px 20px;
-            text-align: left;
-            font-size: 14px;
-            font-weight: 500;
-            border-radius: 4px;
-            cursor: pointer;
-            transition: all 0.2s ease;
-            display: flex;
-            align-items: center;
-            justify-content: space-between;
-            min-height: 52px;
-          }
-          
-          .option-button:hover {
-            background: #e8e8e8;
-            border-color: #c6c6c6;
-          }
-          
-          .option-button:active {
-            background: #d4d4d4;
-          }
-          
-          .option-icon {
-            color: #0f62fe;
-            font-size: 16px;
-            margin-left: 8px;
-          }
-
-          .option-icon-img {
-            width: 16px;
-            height: 16px;
-            object-fit: contain;
-          }
-          
-          .external-link-icon {
-            color: #0f62fe;
-            font-size: 14px;
-          }
-
-          .external-link-icon-img {
-            width: 16px;
-            height: 16px;
-            object-fit: contain;
-          }
-          
-          .go-back-btn {
-            background: #0f62fe;
-            border: none;
-            color: white;
-            padding: 12px 24px;
-            font-size: 14px;
-            font-weight: 500;
-            border-radius: 4px;
-            cursor: pointer;
-            margin-top: 12px;
-            align-self: flex-start;
-            transition: background-color 0.2s ease;
-          }
-          
-          .go-back-btn:hover {
-            background: #0353e9;
-          }
-          
-          .suggestion-text {
-            color: #525252;
-            font-size: 14px;
-            margin-top: 20px;
-            margin-bottom: 16px;
-          }
-          
-          .privacy-notice {
-            background: #f4f4f4;
-            border-top: 1px solid #e0e0e0;
-            padding: 16px 24px;
-            font-size: 12px;
-            color: #525252;
-            line-height: 1.4;
-            position: relative;
-          }
-          
-          .privacy-close {
-            position: absolute;
-            top: 0px;
-            right: 0px;
-            background: none;
-            border: none;
-            font-size: 16px;
-            cursor: pointer;
-            color: #525252;
-            transition: transform 0.5s ease, background 0.5s ease;
-            width: 24px;
-            height: 24px;
-            border-radius: 50%;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-          }
-          
-          .privacy-close:hover {
-            transform: scale(1.4); /* zoom in by 40% */
-          }
-          
-          .privacy-link {
-            color: #0f62fe;
-            text-decoration: none;
-          }
-          
-          .privacy-link:hover {
-            text-decoration: underline;
-          }
-          
-          .input-container {
-            padding: 16px 24px;
-            border-top: 1px solid #e0e0e0;
-            background: #ffffff;
-          }
-          
-          .input-wrapper {
-            display: flex;
-            align-items: center;
-            background: #f4f4f4;
-            border: 1px solid #e0e0e0;
-            border-radius: 4px;
-            padding: 0 16px;
-          }
-          
-          .input-wrapper:focus-within {
-            border-color: #0f62fe;
-            box-shadow: 0 0 0 2px rgba(15, 98, 254, 0.1);
-          }
-          
-          .message-input {
-            flex: 1;
-            border: none;
-            background: none;
-            padding: 16px 0;
-            font-size: 14px;
-            color: #161616;
-            outline: none;
-          }
-          
-          .message-input::placeholder {
-            color: #a8a8a8;
-          }
-          
-          .send-button {
-            background: none;
-            border: none;
-            color: #0f62fe;
-            font-size: 16px;
-            cursor: pointer;
-            padding: 8px;
-            margin-left: 8px;
-            border-radius: 4px;
-            transition: background-color 0.2s ease;
-          }
-          
-          .send-button:hover:not(:disabled) {
-            background: rgba(15, 98, 254, 0.1);
-          }
-          
-          .send-button:disabled {
-            color: #c6c6c6;
-            cursor: not-allowed;
-          }
-          
-          .typing-indicator {
-            padding: 12px 24px;
-            font-style: italic;
-            color: #666;
-            font-size: 14px;
-            display: none;
-          }
-          
-          .typing-indicator.show {
-            display: block;
-          }
-          
-          .typing-dots::after {
-            content: '';
-            animation: dots 1.5s steps(4, end) infinite;
-          }
-          
-          @keyframes dots {
-            0%, 20% { content: ''; }
-            40% { content: '.'; }
-            60% { content: '..'; }
-            80%, 100% { content: '...'; }
-          }
-          
-          @keyframes fadeIn {
-            from { opacity: 0; transform: translateY(10px); }
-            to { opacity: 1; transform: translateY(0); }
-          }
-          
-          .hidden {
-            display: none;
-          }
-          
-          @media (max-width: 768px) {
-            .chat-messages {
-              padding: 16px;
-            }
-            
-            .privacy-notice {
-              padding: 12px 16px 12px 16px;
-            }
-            
-            .input-container {
-              padding: 12px 16px;
-            }
-          }
-        </style>
-      </head>
-      <body>
-        <div class="chat-container">
-          <div class="chat-content">
-            <div class="chat-messages" id="chat-messages">
-              </div>
-            
-            <div class="typing-indicator" id="typing-indicator">
-              <span class="typing-dots">vaspx is typing</span>
-            </div>
-            
-            <div class="privacy-notice" id="privacy-notice">
-              <button class="privacy-close" onclick="closePrivacyNotice()">×</button>
-              By proceeding, you agree that Vasp can process
-              <div>personal information about our conversation, including a text/transcript recording to allow us to respond to your inquiry. Please see <a href="https://www.vasptechnologies.com/privacy-policy" target="_blank" class="privacy-link">Vasp's Privacy Statement</a> to learn about how Vasp processes personal information.
-              </div>
-            </div>
-            
-            <div class="input-container">
-              <div class="input-wrapper">
-                <input type="text" class="message-input" placeholder="Type something..." id="message-input" onkeypress="handleKeyPress(event)">
-                <button class="send-button" onclick="sendMessage()" id="send-button">➤</button>
-              </div>
-            </div>
-          </div>
-        </div>
-
-        <script>
-          // Unique session ID for the user's conversation with Rasa
-          const sessionId = 'user_' + Date.now();
-          
-          function getCurrentTime() {
-            const now = new Date();
-            return now.toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
-          }
-          
-          // Renders a message from the bot
-          function addBotMessage(content) {
-            const messagesContainer = document.getElementById('chat-messages');
-            
-            const messageWrapper = document.createElement('div');
-            messageWrapper.className = 'message-wrapper';
-            
-            const messageHeader = document.createElement('div');
-            messageHeader.className = 'message-header';
-            
-            const botAvatar = document.createElement('div');
-            botAvatar.className = 'bot-avatar';
-            
-            const messageInfo = document.createElement('div');
-            messageInfo.className = 'message-info';
-            
-            const botName = document.createElement('span');
-            botName.className = 'bot-name';
-            botName.textContent = 'vaspx';
-            
-            const timestamp = document.createElement('span');
-            timestamp.className = 'timestamp';
-            timestamp.textContent = getCurrentTime();
-            
-            messageInfo.appendChild(botName);
-            messageInfo.appendChild(timestamp);
-            messageHeader.appendChild(botAvatar);
-            messageHeader.appendChild(messageInfo);
-            
-            const messageContent = document.createElement('div');
-            messageContent.className = 'message-content';
-
-            // Convert **text** to <strong>text</strong>
-            const formattedContent = content.replace(/\*\*(.+?)\*\*/g, '<strong>$1</strong>');
-            messageContent.innerHTML = formattedContent;
-
-            messageWrapper.appendChild(messageHeader);
-            messageWrapper.appendChild(messageContent);
-
-            messagesContainer.appendChild(messageWrapper);
-            scrollToBottom();
-          }
-          
-          // Renders a message from the user
-          function addUserMessage(content) {
-            const messagesContainer = document.getElementById('chat-messages');
-            
-            const messageWrapper = document.createElement('div');
-            messageWrapper.className = 'user-message-wrapper';
-            
-            const messageHeader = document.createElement('div');
-            messageHeader.className = 'user-message-header';
-            
-            const userAvatar = document.createElement('div');
-            userAvatar.className = 'user-avatar';
-            
-            const messageInfo = document.createElement('div');
-            messageInfo.className = 'user-message-info';
-            
-            const userName = document.createElement('span');
-            userName.className = 'user-name';
-            userName.textContent = 'You';
-            
-            const timestamp = document.createElement('span');
-            timestamp.className = 'timestamp';
-            timestamp.textContent = getCurrentTime();
-            
-            messageInfo.appendChild(userAvatar);
-            messageInfo.appendChild(userName);
-            messageInfo.appendChild(timestamp);
-            messageHeader.appendChild(messageInfo);
-            
-            const messageContent = document.createElement('div');
-            messageContent.className = 'user-message-content';
-            messageContent.textContent = content;
-            
-            messageWrapper.appendChild(messageHeader);
-            messageWrapper.appendChild(messageContent);
-            messagesContainer.appendChild(messageWrapper);
-            scrollToBottom();
-          }
-          
-          function showTypingIndicator() {
-            document.getElementById('typing-indicator').classList.add('show');
-            scrollToBottom();
-          }
-          
-          function hideTypingIndicator() {
-            document.getElementById('typing-indicator').classList.remove('show');
-          }
-          
-          function scrollToBottom() {
-            const messagesContainer = document.getElementById('chat-messages');
-            messagesContainer.scrollTop = messagesContainer.scrollHeight;
-          }
-          
-          function closePrivacyNotice() {
-            document.getElementById('privacy-notice').style.display = 'none';
-          }
-          
-          function handleKeyPress(event) {
-            if (event.key === 'Enter') {
-              sendMessage();
-            }
-          }
-          
-          // Called when the user clicks the send button or presses Enter
-          function sendMessage() {
-            const input = document.getElementById('message-input');
-            const message = input.value.trim();
-            if (message) {
-              addUserMessage(message);
-              input.value = '';
-              sendToChatbot(message);
-            }
-          }
-          
-          // Sends the user's message to the backend and displays the bot's response
-          async function sendToChatbot(message) {
-            showTypingIndicator();
-            
-            try {
-              const response = await fetch('/chat', {
-                  method: 'POST',
-                  headers: { 'Content-Type': 'application/json' },
-                  body: JSON.stringify({ message: message, sender: sessionId })
-              });
-
-              if (!response.ok) {
-                  throw new Error(`HTTP Error: ${response.status}`);
-              }
-              
-              const data = await response.json();
-              
-              hideTypingIndicator();
-
-              if (data.responses && data.responses.length > 0) {
-                  // Combine all text parts from Rasa into a single string with newlines
-                  const combinedText = data.responses
-                      .map(resp => resp.text)
-                      .filter(text => text) // Removes any empty responses
-                      .join('\\n\\n'); // Joins messages with a paragraph break
-
-                  // Display the single combined message
-                  if (combinedText) {
-                      addBotMessage(combinedText);
-                  }
-              } else {
-                  addBotMessage("I'm sorry, I didn't get a response. Please try again.");
-              }
-              
-            } catch (error) {
-              console.error('Error:', error);
-              hideTypingIndicator();
-              addBotMessage("❌ Sorry, I'm having trouble connecting. Please ensure the server is running and try again.");
+# The page, its stylesheet and its script live in frontend/ and are built once
+# when the app is imported: CSS/JS get content-hashed URLs so browsers can cache
+# them forever, and every resource is precompressed with gzip and brotli.
+FRONTEND_DIR = "frontend"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# The page itself is revalidated on every load, which is a cheap 304 thanks to its ETag
+PAGE_CACHE_CONTROL = "no-cache"
+# Bodies smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = 512
+
+
+class BuiltAsset:
+    """A response body prepared once, with its compressed variants and ETags."""
+
+    def __init__(self, body: bytes, media_type: str, cache_control: str, compress: bool = True):
+        self.body = body
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.digest = hashlib.sha256(body).hexdigest()
+        self.variants = {"identity": body}
+        if compress and len(body) >= COMPRESS_MIN_BYTES:
+            self.variants["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants["br"] = brotli.compress(body, quality=11)
+        # Strong ETags have to differ between encodings of the same content
+        self.etags = {
+            encoding: f'"{self.digest[:32]}"' if encoding == "identity" else f'"{self.digest[:32]}-{encoding}"'
+            for encoding in self.variants
+        }
+
+
+def accepted_encodings(request: Request) -> List[str]:
+    accepted = []
+    for part in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.append(coding.strip().lower())
+    return accepted
+
+
+def asset_response(request: Request, asset: BuiltAsset, vary: str = "Accept-Encoding") -> Response:
+    """Picks the best encoding for the client and answers conditional requests with 304."""
+    accepted = accepted_encodings(request)
+    encoding = next((e for e in ("br", "gzip") if e in asset.variants and e in accepted), "identity")
+    headers = {
+        "ETag": asset.etags[encoding],
+        "Cache-Control": asset.cache_control,
+        "Vary": vary,
+    }
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        if "*" in tags or tags & set(asset.etags.values()):
+            return Response(status_code=304, headers=headers)
+
+    return Response(content=asset.variants[encoding], media_type=asset.media_type, headers=headers)
+
+
+def hashed_name(name: str, body: bytes) -> str:
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(body).hexdigest()[:12]}{ext}"
+
+
+# --- Assets ---
+# Files in assets/ are fingerprinted the same way and served as immutable.
+# PNG/JPEG images also get WebP and AVIF variants (from a sibling file such as
+# assets/logo.webp, or converted with Pillow when it's installed) which are
+# picked according to the browser's Accept header.
+ASSETS_DIR = "assets"
+IMAGE_VARIANT_FORMATS = (("image/avif", ".avif", "AVIF"), ("image/webp", ".webp", "WEBP"))
+COMPRESSIBLE_TYPES = ("image/svg+xml", "application/json", "application/javascript", "application/manifest+json")
+
+
+def is_compressible(media_type: str) -> bool:
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_TYPES
+
+
+def image_variants(path: str, body: bytes, media_type: str) -> Dict[str, bytes]:
+    """Modern-format versions of an image, only kept when they are smaller than the original."""
+    variants = {}
+    if media_type not in ("image/png", "image/jpeg"):
+        return variants
+
+    stem = os.path.splitext(path)[0]
+    for variant_type, ext, pil_format in IMAGE_VARIANT_FORMATS:
+        if os.path.exists(stem + ext):
+            with open(stem + ext, "rb") as f:
+                converted = f.read()
+        elif Image is not None:
+            try:
+                buffer = io.BytesIO()
+                with Image.open(io.BytesIO(body)) as image:
+                    image.save(buffer, pil_format, quality=80)
+                converted = buffer.getvalue()
+            except (KeyError, OSError, ValueError) as e:
+                print(f"Could not convert {path} to {pil_format}: {e}")
+                continue
+        else:
+            continue
+        if len(converted) < len(body):
+            variants[variant_type] = converted
+    return variants
+
+
+def build_assets() -> tuple:
+    """
+    Returns ({"/assets/<name>": "/assets/<fingerprinted name>"}, {url name: {media type: asset}}).
+    Each entry of the second mapping lists the modern formats first and the original last.
+    """
+    urls = {}
+    assets = {}
+    if not os.path.isdir(ASSETS_DIR):
+        return urls, assets
+
+    for name in sorted(os.listdir(ASSETS_DIR)):
+        path = os.path.join(ASSETS_DIR, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            body = f.read()
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        formats = {**image_variants(path, body, media_type), media_type: body}
+
+        fingerprinted = hashed_name(name, body)
+        urls[f"/{ASSETS_DIR}/{name}"] = f"/{ASSETS_DIR}/{fingerprinted}"
+        for url_name, cache_control in ((fingerprinted, IMMUTABLE_CACHE_CONTROL), (name, PAGE_CACHE_CONTROL)):
+            assets[url_name] = {
+                format_type: BuiltAsset(format_body, format_type, cache_control, compress=is_compressible(format_type))
+                for format_type, format_body in formats.items()
             }
-          }
-          
-          // Initialize chatbot with a hardcoded welcome message on page load
-          document.addEventListener('DOMContentLoaded', function() {
-            const welcomeMessage = "Hi, I am VaspX, an assistant of Vasp Technologies, how can I assist you today?";
-            addBotMessage(welcomeMessage);
-          });
-        </script>
-      </body>
-    </html>
+    return urls, assets
+
+
+def rewrite_asset_urls(text: str, urls: Dict[str, str]) -> str:
+    for original, fingerprinted in urls.items():
+        text = text.replace(original, fingerprinted)
+    return text
+
+
+def build_frontend(asset_urls: Dict[str, str]) -> tuple:
+    """
+    Reads frontend/, points asset references at their fingerprinted URLs,
+    fingerprints the stylesheet and script, rewrites their references in the
+    page and returns (page, {url name: asset}).
+    """
+    static_assets = {}
+    with open(os.path.join(FRONTEND_DIR, "index.html"), encoding="utf-8") as f:
+        page = rewrite_asset_urls(f.read(), asset_urls)
+
+    for name, media_type in (("chat.css", "text/css"), ("chat.js", "text/javascript")):
+        with open(os.path.join(FRONTEND_DIR, name), encoding="utf-8") as f:
+            body = rewrite_asset_urls(f.read(), asset_urls).encode("utf-8")
+        fingerprinted = hashed_name(name, body)
+        static_assets[fingerprinted] = BuiltAsset(body, media_type, IMMUTABLE_CACHE_CONTROL)
+        # The plain name keeps working for anything that hard-coded it, but is revalidated
+        static_assets[name] = BuiltAsset(body, media_type, PAGE_CACHE_CONTROL)
+        page = page.replace(f"/static/{name}", f"/static/{fingerprinted}")
+
+    return BuiltAsset(page.encode("utf-8"), "text/html", PAGE_CACHE_CONTROL), static_assets
+
+
+def build_service_worker(page: BuiltAsset, static_assets: Dict[str, BuiltAsset]) -> BuiltAsset:
     """
+    Fills frontend/sw.js in with the build's version (the page's hash) and
+    the fingerprinted files to precache. Any change to the page or its
+    files changes the worker, and browsers pick up a changed worker on
+    their next visit.
+    """
+    shell = [f"/static/{name}" for name, asset in static_assets.items() if asset.cache_control == IMMUTABLE_CACHE_CONTROL]
+    with open(os.path.join(FRONTEND_DIR, "sw.js"), encoding="utf-8") as f:
+        script = f.read().replace("__VERSION__", page.digest[:12]).replace("__SHELL__", json.dumps(shell))
+    return BuiltAsset(script.encode("utf-8"), "text/javascript", PAGE_CACHE_CONTROL)
+
+
+ASSET_URLS, ASSET_FILES = build_assets()
+HOME_PAGE, STATIC_ASSETS = build_frontend(ASSET_URLS)
+SERVICE_WORKER = build_service_worker(HOME_PAGE, STATIC_ASSETS)
+
+
+@app.get("/", response_class=HTMLResponse)
+async def home(request: Request):
+    return asset_response(request, HOME_PAGE)
+
+
+@app.get("/sw.js")
+async def service_worker(request: Request):
+    """
+    Served next to the page (also under /bots/<name>/), so its scope is
+    exactly the page's directory. no-cache makes browsers check for a new
+    version on every visit.
+    """
+    response = asset_response(request, SERVICE_WORKER)
+    response.headers["Service-Worker-Allowed"] = f"{request.scope.get('root_path', '')}/"
+    return response
+
+
+@app.get("/static/{name}")
+async def static_asset(name: str, request: Request):
+    asset = STATIC_ASSETS.get(name)
+    if asset is None:
+        raise HTTPException(status_code=404)
+    return asset_response(request, asset)
+
+
+@app.get("/assets/{name}")
+async def asset_file(name: str, request: Request):
+    formats = ASSET_FILES.get(name)
+    if formats is None:
+        raise HTTPException(status_code=404)
+    accept = request.headers.get("accept", "")
+    candidates = [t for t in formats if t in accept]
+    media_type = min(candidates, key=lambda t: len(formats[t].body), default=None)
+    # The original format is always last and is what clients that didn't ask for anything get
+    asset = formats[media_type] if media_type else list(formats.values())[-1]
+    return asset_response(request, asset, vary="Accept, Accept-Encoding")
+
+
+async def warm_up_frontend(app: FastAPI):
+    """
+    Requests the page and every static file through the app itself, so the
+    middleware stack, the routes and the responses are set up before the
+    first visitor arrives instead of during their request.
+    """
+    paths = ["/", "/sw.js"] + [f"/static/{name}" for name in STATIC_ASSETS] + [f"/assets/{name}" for name in ASSET_FILES]
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://warmup") as client:
+        for path in paths:
+            try:
+                await client.get(path, headers={"Accept-Encoding": "br, gzip"})
+            except Exception as e:
+                print(f"Warmup request to {path} failed: {e!r}")
 
 
 # --- Backend API ---
+class ChatRequest(BaseModel):
+    """Body of /chat and /chat/stream, also used to check /ws and /chat/batch messages."""
+
+    model_config = ConfigDict(strict=True)
+
+    message: str = Field("", max_length=CHAT_MAX_MESSAGE_LENGTH)
+    sender: str = Field("default", min_length=1, max_length=CHAT_MAX_SENDER_LENGTH)
+    # Overrides the bot picked by the path prefix or host
+    bot: Optional[str] = Field(None, max_length=64)
+
+
+def rasa_payload(sender_id: str, message: str) -> Dict:
+    return {
+        "sender": sender_id,
+        "message": message
+    }
+
+
+@asynccontextmanager
+async def upstream_call(backend: RasaBackend, trial: bool = False):
+    """
+    Wraps one request to Rasa: waits for an admission slot, feeds the
+    backend's breaker and records the timings. Pass timer.trace as the
+    request's "trace" extension. With trial=True (see RasaBackends.pick)
+    the backend's half-open trial is released once the request is over,
+    including when it never got a slot.
+    """
+    try:
+        async with current_tenant.get().admission.slot() as waited:
+            timer = UpstreamTimer()
+            timer.queue = waited
+            try:
+                async with backend.track():
+                    yield timer
+            finally:
+                timer.finish()
+    finally:
+        if trial:
+            backend.trial_in_flight = False
+
+
+async def forward_to_rasa_raw(sender_id: str, message: str) -> bytes:
+    """
+    Sends one message to the sender's Rasa server over the shared connection
+    pool and returns the JSON array it answered with, as undecoded bytes.
+    """
+    tenant = current_tenant.get()
+    backend, trial = tenant.backends.pick(sender_id)
+    async with upstream_call(backend, trial) as timer:
+        rasa_response = await tenant.client.post(
+            backend.webhook_url,
+            content=dumps(rasa_payload(sender_id, message)),
+            headers={"Content-Type": "application/json"},
+            extensions={"trace": timer.trace},
+        )
+        rasa_response.raise_for_status() # Raise an exception for bad status codes
+        body = rasa_response.content.strip()
+        if not (body.startswith(b"[") and body.endswith(b"]")):
+            raise ValueError("Rasa did not return a JSON array")
+        return body
+
+
+async def forward_to_rasa(sender_id: str, message: str) -> list:
+    """Like forward_to_rasa_raw, but returns the decoded responses."""
+    return loads(await forward_to_rasa_raw(sender_id, message))
+
+
+async def stream_from_rasa(sender_id: str, message: str) -> AsyncIterator[Dict]:
+    """
+    Like forward_to_rasa, but yields each item of Rasa's JSON array as soon
+    as it has been fully received instead of waiting for the whole body.
+    """
+    decoder = json.JSONDecoder()
+    tenant = current_tenant.get()
+    backend, trial = tenant.backends.pick(sender_id)
+    async with upstream_call(backend, trial) as timer, tenant.client.stream(
+        "POST",
+        backend.webhook_url,
+        json=rasa_payload(sender_id, message),
+        extensions={"trace": timer.trace},
+    ) as rasa_response:
+        rasa_response.raise_for_status()
+        buffer = ""
+        started = False
+        async for chunk in rasa_response.aiter_text():
+            buffer += chunk
+            while True:
+                buffer = buffer.lstrip()
+                if not buffer:
+                    break
+                if not started:
+                    if buffer[0] != "[":
+                        raise ValueError("Rasa did not return a JSON array")
+                    buffer = buffer[1:]
+                    started = True
+                elif buffer[0] == ",":
+                    buffer = buffer[1:]
+                elif buffer[0] == "]":
+                    return
+                else:
+                    try:
+                        item, end = decoder.raw_decode(buffer)
+                    except json.JSONDecodeError:
+                        break # Wait for the rest of this item
+                    buffer = buffer[end:]
+                    yield item
+        if not started:
+            raise ValueError("Rasa returned an empty body")
+
+
+def error_responses(error: Exception) -> list:
+    """The messages shown to the user when Rasa can't be reached or fails."""
+    if isinstance(error, httpx.RequestError):
+        print(f"Error connecting to Rasa: {error}")
+        CHAT_ERRORS.inc("connect")
+        return [{
+            "text": f"Error: Could not connect to the Rasa server at {error.request.url}. Please check if it's running."
+        }]
+    print(f"An unexpected error occurred: {error}")
+    CHAT_ERRORS.inc("upstream_status" if isinstance(error, httpx.HTTPStatusError) else "unexpected")
+    return [{
+        "text": "An unexpected error occurred on the server. Please check the logs."
+    }]
+
+
+def stale_responses(cache_key: str, sender_id: str) -> Optional[list]:
+    cache = current_tenant.get().cache
+    if not CHAT_CACHE_SERVE_STALE or not cache.is_cacheable(cache_key):
+        return None
+    stale = cache.get_stale(cache_key)
+    return for_sender(stale, sender_id) if stale is not None else None
+
+
+async def answer_turn(sender_id: str, message: str, raw: bool = False):
+    """
+    Answers one user turn from the cache when possible, otherwise asks Rasa.
+    Errors are turned into a message for the user; the only exception raised
+    is UpstreamOverloaded, when there is no stale answer to fall back on.
+
+    With raw=True, an answer that comes straight from Rasa is returned as the
+    undecoded bytes of its JSON array instead of a list.
+    """
+    timing = turn_timing.get()
+    if timing is not None:
+        # Time spent behind the sender's earlier turns
+        timing.queue += time.perf_counter() - timing.turn_started
+
+    tenant = current_tenant.get()
+    fast = tenant.fast_path.answer(sender_id, message)
+    if fast is not None:
+        return fast
+
+    cache_key = normalize_message(message)
+    cacheable = tenant.cache.is_cacheable(cache_key)
+
+    try:
+        if cacheable:
+            cached = tenant.cache.get(cache_key)
+            if cached is not None:
+                return for_sender(cached, sender_id)
+
+        if raw and not cacheable:
+            return await forward_to_rasa_raw(sender_id, message)
+
+        bot_responses = await forward_to_rasa(sender_id, message)
+        if cacheable:
+            tenant.cache.set(cache_key, bot_responses)
+        return bot_responses
+
+    except UpstreamOverloaded:
+        stale = stale_responses(cache_key, sender_id)
+        if stale is None:
+            raise
+        return stale
+    except Exception as e:
+        fallback = error_responses(e)
+        stale = stale_responses(cache_key, sender_id)
+        return stale if stale is not None else fallback
+
+
+async def stream_answer_turn(sender_id: str, message: str) -> AsyncIterator[Dict]:
+    """Streaming counterpart of answer_turn."""
+    tenant = current_tenant.get()
+    fast = tenant.fast_path.answer(sender_id, message)
+    if fast is not None:
+        for item in fast:
+            yield item
+        return
+
+    cache_key = normalize_message(message)
+    cacheable = tenant.cache.is_cacheable(cache_key)
+
+    if cacheable:
+        cached = tenant.cache.get(cache_key)
+        if cached is not None:
+            for item in for_sender(cached, sender_id):
+                yield item
+            return
+
+    received = []
+    try:
+        async for item in stream_from_rasa(sender_id, message):
+            received.append(item)
+            yield item
+    except UpstreamOverloaded:
+        stale = stale_responses(cache_key, sender_id)
+        if stale is None:
+            raise
+        for item in stale:
+            yield item
+        return
+    except Exception as e:
+        fallback = error_responses(e)
+        if received:
+            return # Part of the answer already reached the user, don't mix in another one
+        stale = stale_responses(cache_key, sender_id)
+        for item in stale if stale is not None else fallback:
+            yield item
+        return
+
+    if cacheable:
+        tenant.cache.set(cache_key, received)
+
+
+async def mirrored_turn(sender_id: str, message: str, raw: bool = False):
+    """
+    answer_turn, then hands the answer to the shadow mirror. Runs inside the
+    sender's turn, so coalesced duplicates are mirrored once, like they reach
+    Rasa once, and in the sender's order.
+    """
+    # The turn runs in its own task, a timing set here stays with this turn
+    timing = turn_timing.get()
+    if timing is None:
+        timing = TurnTiming(time.perf_counter())
+        turn_timing.set(timing)
+    result = await answer_turn(sender_id, message, raw)
+    shadow.mirror(sender_id, message, result, timing.upstream_seconds())
+    return result
+
+
+async def mirrored_stream_turn(sender_id: str, message: str) -> AsyncIterator[Dict]:
+    """Streaming counterpart of mirrored_turn."""
+    # Streamed turns report no Server-Timing, this only collects Rasa's time for the comparison
+    timing = TurnTiming(time.perf_counter())
+    turn_timing.set(timing)
+    received = []
+    async for item in stream_answer_turn(sender_id, message):
+        received.append(item)
+        yield item
+    shadow.mirror(sender_id, message, received, timing.upstream_seconds())
+
+
+async def handle_turn(sender_id: str, message: str, raw: bool = False):
+    """
+    Runs one user turn in order with the sender's other turns. With raw=True
+    the result may be the raw bytes of Rasa's answer (see answer_turn).
+    """
+    global turns_in_flight
+    turns_in_flight += 1
+    start = time.perf_counter()
+    try:
+        sender_key = current_tenant.get().sender_key(sender_id)
+        result = await sender_queues.run(sender_key, message, lambda: mirrored_turn(sender_id, message, raw))
+        transcripts.record(sender_id, message, result)
+        # A coalesced turn may have been started by a caller that wanted the other form
+        if not raw and isinstance(result, bytes):
+            result = loads(result)
+        return result
+    except UpstreamOverloaded:
+        CHAT_ERRORS.inc("overloaded")
+        raise
+    finally:
+        turns_in_flight -= 1
+        TURN_SECONDS.observe(time.perf_counter() - start)
+
+
+async def stream_turn(sender_id: str, message: str) -> AsyncIterator[Dict]:
+    """Streaming counterpart of handle_turn."""
+    global turns_in_flight
+    turns_in_flight += 1
+    start = time.perf_counter()
+    received = []
+    try:
+        sender_key = current_tenant.get().sender_key(sender_id)
+        async for item in sender_queues.stream(sender_key, message, lambda: mirrored_stream_turn(sender_id, message)):
+            received.append(item)
+            yield item
+        transcripts.record(sender_id, message, received)
+    except UpstreamOverloaded:
+        CHAT_ERRORS.inc("overloaded")
+        raise
+    finally:
+        turns_in_flight -= 1
+        TURN_SECONDS.observe(time.perf_counter() - start)
+
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {dumps(data)}\n\n"
+
+
+async def sse_turn(sender_id: str, message: str) -> AsyncIterator[str]:
+    """
+    Emits one "message" event per Rasa response and a final "done" event
+    (carrying the mode hint, see mode_hint), with heartbeat comments while
+    Rasa is still working so proxies keep the connection open. When Rasa is
+    overloaded an "overloaded" event carrying the message to show and
+    retry_after replaces the responses.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def produce():
+        try:
+            async for item in stream_turn(sender_id, message):
+                await queue.put(item)
+        except UpstreamOverloaded as e:
+            await queue.put(e)
+        finally:
+            await queue.put(done)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=CHAT_STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            if item is done:
+                break
+            if isinstance(item, UpstreamOverloaded):
+                yield sse_event("overloaded", {"text": OVERLOADED_MESSAGE, "retry_after": item.retry_after})
+                continue
+            yield sse_event("message", item)
+        yield sse_event("done", mode_hint())
+    finally:
+        producer.cancel()
+
+
+def project_responses(responses: list, fields: Optional[List[str]], join: bool) -> list:
+    """
+    Keeps only the given fields of each response (dropping responses left
+    empty) and, with join, merges all texts into the first response the way
+    the page shows them. Other fields stay on their own responses, except
+    recipient_id which is only kept once, on the first response.
+    """
+    if fields is not None:
+        responses = [{k: v for k, v in r.items() if k in fields} for r in responses]
+    if join:
+        texts = [r["text"] for r in responses if r.get("text")]
+        recipient = next(({"recipient_id": r["recipient_id"]} for r in responses if "recipient_id" in r), {})
+        rest = [{k: v for k, v in r.items() if k not in ("text", "recipient_id")} for r in responses]
+        head = {**recipient, "text": "\n\n".join(texts)} if texts else {**recipient, **(rest.pop(0) if rest else {})}
+        responses = [head] + rest
+    return [r for r in responses if r]
+
+
+def compressed_response(request: Request, body: bytes) -> Response:
+    encoding = None
+    if CHAT_COMPRESS_MIN_BYTES and len(body) >= CHAT_COMPRESS_MIN_BYTES:
+        accepted = accepted_encodings(request)
+        if brotli is not None and "br" in accepted:
+            # Low quality levels, this runs for every response
+            encoding, body = "br", brotli.compress(body, quality=4)
+        elif "gzip" in accepted:
+            encoding, body = "gzip", gzip.compress(body, compresslevel=5)
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def client_ip(connection: HTTPConnection) -> Optional[str]:
+    return connection.client.host if connection.client else None
+
+
+def require_bearer(request: Request, token: str):
+    """Admin endpoints: 404 while their token is unset, 401 unless the request carries it."""
+    if not token:
+        raise HTTPException(status_code=404)
+    scheme, _, given = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(given.encode(), token.encode()):
+        raise HTTPException(status_code=401, headers={"WWW-Authenticate": "Bearer"})
+
+
 @app.post("/chat")
-async def chat(request: Dict):
+async def chat(
+    request: ChatRequest, http_request: Request, fields: Optional[str] = None, join: bool = False, mode: str = "sync"
+):
     """
     This endpoint receives a message from the frontend, forwards it to the
     Rasa server, and returns Rasa's response.
+
+    ?fields=text,buttons keeps only those fields of each response and
+    ?join=true merges their texts into one (see project_responses).
+    With ?mode=async it answers 202 {"job": id} right away instead, and
+    the responses are fetched from /chat/jobs/{id}.
     """
+    resolve_tenant(request.bot)
+    if mode == "async":
+        return await submit_chat_job(request, http_request)
+    CHAT_REQUESTS.inc("http")
+    wanted = [f.strip() for f in fields.split(",") if f.strip()] if fields is not None else None
+    # Projecting needs the decoded responses
+    raw = CHAT_RAW_PASSTHROUGH and wanted is None and not join
+    timing = TurnTiming(getattr(http_request.state, "received_at", time.perf_counter()))
+    turn_timing.set(timing)
     try:
-        user_message = request.get("message", "")
-        sender_id = request.get("sender", "default")
-        
-        # Payload for the Rasa server
-        rasa_payload = {
-            "sender": sender_id,
-            "message": user_message
-        }
-        
-        # Send the message to the Rasa server and get the response
-        async with httpx.AsyncClient() as client:
-            rasa_response = await client.post(
-                RASA_SERVER_URL,
-                json=rasa_payload,
-                timeout=30.0
-            )
-            rasa_response.raise_for_status() # Raise an exception for bad status codes
-            
-            bot_responses = rasa_response.json()
-            return {"responses": bot_responses}
-            
-    except httpx.RequestError as e:
-        print(f"Error connecting to Rasa: {e}")
-        return {
-            "responses": [{
-                "text": f"Error: Could not connect to the Rasa server at {RASA_SERVER_URL}. Please check if it's running."
-            }]
-        }
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        return {
-            "responses": [{
-                "text": "An unexpected error occurred on the server. Please check the logs."
-            }]
-        }
+        await check_rate_limits(request.sender, client_ip(http_request))
+        timing.turn_started = time.perf_counter()
+        result = await handle_turn(request.sender, request.message, raw=raw)
+    except RateLimited as e:
+        response = rate_limited_response(e)
+    except UpstreamOverloaded as e:
+        response = overloaded_response(e)
+    else:
+        timing.serialize_started = time.perf_counter()
+        if isinstance(result, bytes):
+            # Rasa's array is spliced into the envelope as is, no decode/encode round trip
+            body = b'{"responses":' + result + b"}"
+        else:
+            if wanted is not None or join:
+                result = project_responses(result, wanted, join)
+            body = dumps_bytes({"responses": result})
+        response = compressed_response(http_request, body)
+    response.headers["Server-Timing"] = timing.header()
+    return with_mode_hint(response)
+
+
+def mode_hint() -> Dict[str, str]:
+    """{"mode": "async"} while the current bot's Rasa is slow (see CHAT_ASYNC_LATENCY_HINT), else {}."""
+    if CHAT_ASYNC_LATENCY_HINT and current_tenant.get().backends.recent_latency() > CHAT_ASYNC_LATENCY_HINT:
+        return {"mode": "async"}
+    return {}
+
+
+def with_mode_hint(response: Response) -> Response:
+    """Tells the page to use async job mode while Rasa is slow."""
+    if mode_hint():
+        response.headers["X-Chat-Mode"] = "async"
+    return response
+
+
+async def submit_chat_job(request: ChatRequest, http_request: Request) -> Response:
+    CHAT_REQUESTS.inc("async")
+    try:
+        await check_rate_limits(request.sender, client_ip(http_request))
+        job = chat_jobs.submit(request.sender, request.message)
+    except RateLimited as e:
+        return rate_limited_response(e)
+    except UpstreamOverloaded as e:
+        CHAT_ERRORS.inc("overloaded")
+        return overloaded_response(e)
+    return json_response(
+        {"job": job.id, "status": job.status},
+        status_code=202,
+        headers={"Location": f"{http_request.scope.get('root_path', '')}/chat/jobs/{job.id}"},
+    )
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """
+    Same as /chat, but streams each of Rasa's responses as a Server-Sent
+    Event as soon as it arrives.
+    """
+    CHAT_REQUESTS.inc("stream")
+    resolve_tenant(request.bot)
+    try:
+        await check_rate_limits(request.sender, client_ip(http_request))
+    except RateLimited as e:
+        return rate_limited_response(e)
+    return StreamingResponse(
+        sse_turn(request.sender, request.message),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def ndjson_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+async def batch_turn(sender_id: str, message: str) -> list:
+    """A turn of a batch: waits and retries when Rasa is overloaded instead of failing right away."""
+    CHAT_REQUESTS.inc("batch")
+    for attempt in range(CHAT_BATCH_RETRIES + 1):
+        try:
+            return await handle_turn(sender_id, message)
+        except UpstreamOverloaded as e:
+            if attempt == CHAT_BATCH_RETRIES:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+
+async def run_batch(lines: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    Runs every {"sender", "message"} line (with an optional "bot") as a turn
+    and yields one result line per input line as soon as it is done, tagged
+    with the line's index (and its "id" if it had one). Turns of one sender
+    run in input order.
+    """
+    results: asyncio.Queue = asyncio.Queue()
+    parallel = asyncio.Semaphore(CHAT_BATCH_CONCURRENCY)
+    read_ahead = asyncio.Semaphore(CHAT_BATCH_MAX_PENDING)
+    last_turn: Dict[str, asyncio.Task] = {}
+    finished = object()
+
+    async def run_item(index: int, item_id, turn: ChatRequest, tenant: Tenant, previous: Optional[asyncio.Task]):
+        current_tenant.set(tenant)
+        result = {"index": index}
+        if item_id is not None:
+            result["id"] = item_id
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            async with parallel:
+                result["sender"] = turn.sender
+                result["responses"] = await batch_turn(turn.sender, turn.message)
+        except UpstreamOverloaded as e:
+            result["error"] = "overloaded"
+            result["retry_after"] = e.retry_after
+        finally:
+            read_ahead.release()
+        await results.put(result)
+
+    def forget(sender_id: str, task: asyncio.Task):
+        if last_turn.get(sender_id) is task:
+            del last_turn[sender_id]
+
+    async def read():
+        tasks = set()
+        index = 0
+        try:
+            async for line in lines:
+                await read_ahead.acquire()
+                try:
+                    item = loads(line)
+                    if not isinstance(item, dict):
+                        raise ValueError("expected a JSON object")
+                    item_id = item.pop("id", None)
+                    turn = ChatRequest.model_validate(item)
+                    tenant = tenants.get(turn.bot) if turn.bot is not None else current_tenant.get()
+                    if tenant is None:
+                        raise ValueError(f"unknown bot {turn.bot!r}")
+                except ValueError as e: # ValidationError is a ValueError too
+                    read_ahead.release()
+                    await results.put({"index": index, "error": f"invalid line: {e}"})
+                    index += 1
+                    continue
+
+                sender_key = tenant.sender_key(turn.sender)
+                task = asyncio.create_task(run_item(index, item_id, turn, tenant, last_turn.get(sender_key)))
+                last_turn[sender_key] = task
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda t, s=sender_key: forget(s, t))
+                index += 1
+            if tasks:
+                await asyncio.wait(tasks)
+        except ClientDisconnect:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            await results.put(finished)
 
-# Health check endpoint
+    reader = asyncio.create_task(read())
+    try:
+        while True:
+            result = await results.get()
+            if result is finished:
+                break
+            yield dumps(result) + "\n"
+    finally:
+        reader.cancel()
+
+
+class DuplexStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse that doesn't listen for the client disconnecting,
+    which would swallow the request body, so the body can still be read
+    while the response streams. A disconnect ends request.stream() instead.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+@app.post("/chat/batch")
+async def chat_batch(request: Request):
+    """
+    Bulk evaluation and replay: takes NDJSON {"sender", "message"} lines and
+    streams back NDJSON {"index", "sender", "responses"} lines as turns finish.
+    Needs CHAT_BATCH_TOKEN as a bearer token.
+    """
+    require_bearer(request, CHAT_BATCH_TOKEN)
+    return DuplexStreamingResponse(run_batch(ndjson_lines(request.stream())), media_type="application/x-ndjson")
+
+
+# --- Async jobs ---
+class ChatJob:
+    def __init__(self, sender_id: str, message: str):
+        # Unguessable, the id is all it takes to read the answer
+        self.id = secrets.token_urlsafe(16)
+        self.sender_id = sender_id
+        self.message = message
+        self.tenant = current_tenant.get()
+        self.status = "queued"
+        self.responses: Optional[list] = None
+        self.error: Optional[str] = None
+        self.finished_at = 0.0
+        self.done = asyncio.Event()
+
+
+class ChatJobs:
+    """
+    Turns submitted with POST /chat?mode=async. They wait in a bounded FIFO
+    queue and CHAT_JOB_WORKERS workers answer them through handle_turn, so a
+    sender's jobs still run in order. Finished jobs are kept for
+    CHAT_JOB_TTL seconds for clients to collect.
+    """
+
+    def __init__(self, workers: int, queue_size: int, ttl: float):
+        self.worker_count = workers
+        self.ttl = ttl
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.jobs: OrderedDict = OrderedDict()
+        self.workers: List[asyncio.Task] = []
+        self.rejected = 0
+        self.expired = 0
+
+    def submit(self, sender_id: str, message: str) -> ChatJob:
+        """Queues a turn; raises UpstreamOverloaded when the queue is full."""
+        self.evict()
+        job = ChatJob(sender_id, message)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise UpstreamOverloaded(RASA_RETRY_AFTER)
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[ChatJob]:
+        self.evict()
+        return self.jobs.get(job_id)
+
+    def evict(self):
+        # Jobs are in submission order, so expired ones are found at the front
+        cutoff = time.monotonic() - self.ttl
+        while self.jobs:
+            job = next(iter(self.jobs.values()))
+            if not (job.done.is_set() and job.finished_at < cutoff):
+                break
+            del self.jobs[job.id]
+            self.expired += 1
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            job.status = "running"
+            current_tenant.set(job.tenant)
+            try:
+                job.responses = await handle_turn(job.sender_id, job.message)
+                job.status = "done"
+            except UpstreamOverloaded:
+                job.responses = [{"text": OVERLOADED_MESSAGE}]
+                job.status = "failed"
+                job.error = "overloaded"
+            finally:
+                job.finished_at = time.monotonic()
+                job.done.set()
+
+    def start(self):
+        self.workers = [asyncio.create_task(self.work()) for _ in range(self.worker_count)]
+
+    def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+    def stats(self) -> Dict:
+        counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        for job in self.jobs.values():
+            counts[job.status] += 1
+        return {**counts, "rejected": self.rejected, "expired": self.expired}
+
+
+chat_jobs = ChatJobs(CHAT_JOB_WORKERS, CHAT_JOB_QUEUE_SIZE, CHAT_JOB_TTL)
+
+
+def job_body(job: ChatJob, fields: Optional[str], join: bool) -> Dict:
+    body = {"job": job.id, "status": job.status}
+    if job.done.is_set():
+        wanted = [f.strip() for f in fields.split(",") if f.strip()] if fields is not None else None
+        body["responses"] = project_responses(job.responses, wanted, join) if wanted is not None or join else job.responses
+        if job.error:
+            body["error"] = job.error
+    return body
+
+
+@app.get("/chat/jobs/{job_id}")
+async def chat_job(job_id: str, request: Request, wait: float = CHAT_JOB_POLL_TIMEOUT, fields: Optional[str] = None, join: bool = False):
+    """
+    Long-polls an async turn: answers as soon as the job finishes, or with
+    202 {"status": "queued" | "running"} after ?wait seconds (at most
+    CHAT_JOB_POLL_TIMEOUT) so the client polls again. Takes the same
+    fields/join parameters as /chat. Unknown or expired jobs are a 404.
+    """
+    job = chat_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404)
+    if not job.done.is_set():
+        try:
+            await asyncio.wait_for(job.done.wait(), timeout=max(0.0, min(wait, CHAT_JOB_POLL_TIMEOUT)))
+        except asyncio.TimeoutError:
+            return json_response(job_body(job, fields, join), status_code=202)
+    return with_mode_hint(compressed_response(request, dumps_bytes(job_body(job, fields, join))))
+
+
+@app.websocket("/ws")
+async def chat_socket(websocket: WebSocket, sender: str = "default", bot: Optional[str] = None):
+    """
+    Persistent chat session for one sender (with ?bot=, or the bot picked by
+    the path prefix or host). The client sends
+    {"type": "message", "id": ..., "message": ...} frames and receives one
+    {"type": "response"} frame per Rasa response followed by {"type": "done"}.
+    Both sides answer {"type": "ping"} with {"type": "pong"}.
+    """
+    if not 0 < len(sender) <= CHAT_MAX_SENDER_LENGTH:
+        await websocket.close(code=1008, reason="invalid sender")
+        return
+    if bot is not None:
+        if tenants.get(bot) is None:
+            await websocket.close(code=1008, reason="unknown bot")
+            return
+        current_tenant.set(tenants.get(bot))
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+    turns: asyncio.Queue = asyncio.Queue(maxsize=WS_MAX_PENDING_TURNS)
+
+    async def send(frame: Dict):
+        async with send_lock:
+            await websocket.send_text(dumps(frame))
+
+    async def run_turns():
+        # Turns of one session are answered in the order they were sent
+        while True:
+            turn_id, message = await turns.get()
+            try:
+                async for item in stream_turn(sender, message):
+                    await send({"type": "response", "id": turn_id, "response": item})
+            except UpstreamOverloaded as e:
+                await send({"type": "overloaded", "id": turn_id, "text": OVERLOADED_MESSAGE, "retry_after": e.retry_after})
+            await send({"type": "done", "id": turn_id, **mode_hint()})
+
+    worker = asyncio.create_task(run_turns())
+    last_seen = last_message = time.monotonic()
+    try:
+        while True:
+            try:
+                frame = loads(await asyncio.wait_for(websocket.receive_text(), timeout=WS_PING_INTERVAL))
+            except asyncio.TimeoutError:
+                now = time.monotonic()
+                if now - last_seen > 2 * WS_PING_INTERVAL:
+                    await websocket.close(code=1001, reason="ping timeout")
+                    break
+                if now - last_message > WS_IDLE_TIMEOUT and turns.empty():
+                    await websocket.close(code=1000, reason="idle timeout")
+                    break
+                await send({"type": "ping"})
+                continue
+
+            last_seen = time.monotonic()
+            kind = frame.get("type") if isinstance(frame, dict) else None
+            if kind == "message":
+                last_message = last_seen
+                try:
+                    turn = ChatRequest(message=frame.get("message", ""), sender=sender)
+                except ValidationError as e:
+                    await send({"type": "error", "id": frame.get("id"), "detail": e.errors(include_url=False, include_context=False)})
+                    await send({"type": "done", "id": frame.get("id")})
+                    continue
+                CHAT_REQUESTS.inc("websocket")
+                # Checked on arrival, so a flood is turned away before it's queued
+                try:
+                    await check_rate_limits(sender, client_ip(websocket))
+                    turns.put_nowait((frame.get("id"), turn.message))
+                except RateLimited as e:
+                    await send({"type": "rate_limited", "id": frame.get("id"), "text": RATE_LIMITED_MESSAGE, "retry_after": e.retry_after})
+                    await send({"type": "done", "id": frame.get("id")})
+                except asyncio.QueueFull:
+                    CHAT_ERRORS.inc("overloaded")
+                    await send({"type": "overloaded", "id": frame.get("id"), "text": OVERLOADED_MESSAGE, "retry_after": RASA_RETRY_AFTER})
+                    await send({"type": "done", "id": frame.get("id")})
+            elif kind == "ping":
+                await send({"type": "pong"})
+    except (WebSocketDisconnect, json.JSONDecodeError, RuntimeError):
+        pass
+    finally:
+        worker.cancel()
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    lines += gauge("chatbot_turns_in_flight", "Turns being answered", [({}, turns_in_flight)])
+    lines += gauge("chatbot_active_senders", "Senders with a turn queued or in flight", [({}, len(sender_queues.senders))])
+    lines += gauge("chatbot_coalesced_total", "Duplicate messages that shared an in-flight turn", [
+        ({}, sender_queues.coalesced),
+    ], kind="counter")
+
+    bots = list(tenants.tenants.values())
+    admission_stats = {tenant.name: tenant.admission.stats() for tenant in bots}
+    lines += gauge("chatbot_upstream_in_flight", "Requests to Rasa in flight", [
+        ({"bot": bot}, stats["in_flight"]) for bot, stats in admission_stats.items()
+    ])
+    lines += gauge("chatbot_upstream_queued", "Requests waiting for an admission slot", [
+        ({"bot": bot}, stats["queued"]) for bot, stats in admission_stats.items()
+    ])
+    lines += gauge("chatbot_upstream_concurrency_limit", "Current admission limit", [
+        ({"bot": bot}, stats["limit"]) for bot, stats in admission_stats.items()
+    ])
+    lines += gauge("chatbot_upstream_rejected_total", "Requests rejected by admission control", [
+        ({"bot": bot, "reason": reason}, stats[key])
+        for bot, stats in admission_stats.items()
+        for reason, key in (("queue_full", "rejected"), ("queue_timeout", "timed_out"))
+    ], kind="counter")
+
+    job_stats = chat_jobs.stats()
+    lines += gauge("chatbot_jobs", "Async chat jobs held, by status", [
+        ({"status": status}, job_stats[status]) for status in ("queued", "running", "done", "failed")
+    ])
+    lines += gauge("chatbot_jobs_dropped_total", "Async chat jobs rejected with a full queue or evicted after CHAT_JOB_TTL", [
+        ({"reason": "rejected"}, job_stats["rejected"]),
+        ({"reason": "expired"}, job_stats["expired"]),
+    ], kind="counter")
+
+    lines += gauge("chatbot_rate_limit_keys", "Keys tracked by each in-memory rate limiter", [
+        ({"scope": limiter.scope}, limiter.stats()["keys"]) for limiter in (ip_limiter, sender_limiter)
+    ])
+
+    lines += gauge("chatbot_pool_connections", "Connections held by the upstream pool", [
+        ({"bot": tenant.name, "state": state}, count)
+        for tenant in bots
+        for state, count in pool_connections(tenant.client).items()
+    ])
+    lines += gauge("chatbot_pool_max_connections", "Upstream pool size limit", [
+        ({"bot": tenant.name}, tenant.max_connections) for tenant in bots
+    ])
+
+    cache_stats = {tenant.name: tenant.cache.stats() for tenant in bots}
+    lines += gauge("chatbot_cache_lookups_total", "Response cache lookups", [
+        ({"bot": bot, "result": result}, stats[key])
+        for bot, stats in cache_stats.items()
+        for result, key in (("hit", "hits"), ("miss", "misses"), ("stale", "stale_hits"))
+    ], kind="counter")
+    lines += gauge("chatbot_cache_hit_ratio", "Response cache hit ratio", [
+        ({"bot": bot}, stats["hit_ratio"]) for bot, stats in cache_stats.items()
+    ])
+    lines += gauge("chatbot_fast_path_hit_ratio", "Share of looked up messages answered by the fast path", [
+        ({"bot": tenant.name}, tenant.fast_path.stats()["hit_ratio"]) for tenant in bots
+    ])
+    lines += gauge("chatbot_cache_entries", "Entries in the response cache", [
+        ({"bot": bot}, stats["entries"]) for bot, stats in cache_stats.items()
+    ])
+
+    backend_stats = [dict(b, bot=tenant.name) for tenant in bots for b in tenant.backends.stats()]
+    for name, help, key, kind in (
+        ("chatbot_backend_requests_total", "Requests sent to each Rasa server", "requests", "counter"),
+        ("chatbot_backend_errors_total", "Failed requests to each Rasa server", "errors", "counter"),
+        ("chatbot_backend_latency_seconds", "Recent average latency of each Rasa server", "latency_ewma", "gauge"),
+    ):
+        lines += gauge(name, help, [({"bot": b["bot"], "backend": b["url"]}, b[key]) for b in backend_stats], kind=kind)
+    transcript_stats = transcripts.stats()
+    lines += gauge("chatbot_transcript_queued", "Transcript entries waiting to be written", [({}, transcript_stats["queued"])])
+    lines += gauge("chatbot_transcript_queue_capacity", "Size limit of the transcript queue", [({}, TRANSCRIPT_QUEUE_SIZE)])
+    lines += gauge("chatbot_transcript_entries_total", "Transcript entries by outcome", [
+        ({"outcome": outcome}, transcript_stats[outcome]) for outcome in ("recorded", "dropped", "written", "failed")
+    ], kind="counter")
+
+    shadow_stats = shadow.stats()
+    lines += gauge("chatbot_shadow_queued", "Turns waiting to be replayed to the shadow server", [({}, shadow_stats["queued"])])
+    lines += gauge("chatbot_shadow_turns_total", "Turns mirrored to the shadow server, by outcome", [
+        ({"bot": bot, "outcome": outcome}, stats[outcome])
+        for bot, stats in shadow_stats["bots"].items()
+        for outcome in ("matched", "differed", "failed", "dropped")
+    ], kind="counter")
+
+    lines += gauge("chatbot_ready", "Whether this worker reports ready", [
+        ({}, int(app_ready and tenants.readiness() is None)),
+    ])
+    lines += gauge("chatbot_backend_available", "Whether each Rasa server is taking traffic", [
+        ({"bot": b["bot"], "backend": b["url"]}, int(b["healthy"] and b["state"] != "open")) for b in backend_stats
+    ])
+    return "\n".join(lines) + "\n"
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/backends")
+def backends():
+    """Per Rasa server routing state, latency and error counters."""
+    return {
+        "backends": [dict(b, bot=tenant.name) for tenant in tenants.tenants.values() for b in tenant.backends.stats()],
+    }
+
+
+@app.get("/transcripts/{sender_id}")
+async def transcript(
+    sender_id: str, request: Request, limit: int = 50, before: Optional[int] = None, bot: str = DEFAULT_TENANT
+):
+    """A sender's conversation history with a bot, newest first; page back with ?before=<id of the oldest entry>."""
+    require_bearer(request, TRANSCRIPT_ADMIN_TOKEN if transcripts.enabled else "")
+    entries = await asyncio.to_thread(transcripts.history, bot, sender_id, max(1, min(limit, 500)), before)
+    return json_response({"bot": bot, "sender": sender_id, "entries": entries})
+
+
+# Health check endpoints: /health and /health/live only say the process is up
+# (a failing liveness check gets the instance restarted), /health/ready says
+# whether it should get traffic. Neither calls Rasa, readiness reads the result
+# of the background probes.
 @app.get("/health")
 def health():
-    return {"status": "healthy", "message": "Vasp Assistant is running!"}
+    return {
+        "status": "healthy",
+        "ready": app_ready and tenants.readiness() is None,
+        "message": "Vasp Assistant is running!",
+        **tenants.default.stats(),
+        "bots": {name: tenant.stats() for name, tenant in tenants.tenants.items() if tenant is not tenants.default},
+        "senders": sender_queues.stats(),
+        "jobs": chat_jobs.stats(),
+        "rate_limits": {"ip": ip_limiter.stats(), "sender": sender_limiter.stats()},
+        "transcripts": transcripts.stats(),
+        "shadow": shadow.stats(),
+    }
+
+
+@app.get("/health/live")
+def health_live():
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+def health_ready():
+    reason = "starting up or shutting down" if not app_ready else tenants.readiness()
+    if reason is not None:
+        return json_response({"status": "not_ready", "reason": reason}, status_code=503)
+    return {
+        "status": "ready",
+        "backends": [
+            {"bot": tenant.name, "url": b.base_url, "reachable": bool(b.last_probe_ok), "state": b.state}
+            for tenant in tenants.tenants.values()
+            for b in tenant.backends.backends
+        ],
+    }
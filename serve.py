@@ -0,0 +1,152 @@
+"""
+Production entry point: python serve.py
+
+Runs main:app in several worker processes sized to the CPUs available to the
+container. With gunicorn installed the app is imported once in the master
+process and forked into the workers (so the built page and assets are shared
+memory), otherwise uvicorn's own process manager is used. uvloop and
+httptools are used when installed. On SIGTERM workers stop accepting new
+connections and get GRACEFUL_TIMEOUT seconds to finish in-flight requests.
+
+Tuning (environment variables):
+    HOST, PORT           Where to listen (0.0.0.0:8000)
+    WEB_CONCURRENCY      Worker processes (default: available CPUs)
+    GRACEFUL_TIMEOUT     Seconds to drain on shutdown (30)
+    WORKER_TIMEOUT       Seconds before a stuck worker is restarted (60, gunicorn only)
+    KEEPALIVE            Seconds to keep idle client connections open (5)
+    BACKLOG              Pending connection queue size (2048)
+    MAX_REQUESTS         Recycle a worker after this many requests, 0 = never (0)
+    LOG_LEVEL            debug, info, warning, error (info)
+    FORWARDED_ALLOW_IPS  Proxies whose X-Forwarded-For/-Proto are trusted, comma
+                         separated or * (127.0.0.1). Behind a load balancer set it
+                         to the balancer's addresses (or * when only the balancer
+                         can reach the app), otherwise every visitor appears
+                         with the balancer's IP and shares one per-IP rate limit.
+"""
+import gc
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+APP = "main:app"
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", 8000))
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+WORKER_TIMEOUT = int(os.getenv("WORKER_TIMEOUT", 60))
+KEEPALIVE = int(os.getenv("KEEPALIVE", 5))
+BACKLOG = int(os.getenv("BACKLOG", 2048))
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", 0))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info")
+FORWARDED_ALLOW_IPS = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+
+def available_cpus() -> int:
+    """CPUs this process may use, honouring the affinity mask and a cgroup v2 CPU quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def worker_count() -> int:
+    return int(os.getenv("WEB_CONCURRENCY", available_cpus()))
+
+
+def event_loop() -> str:
+    try:
+        import uvloop  # noqa: F401
+        return "uvloop"
+    except ImportError:
+        return "asyncio"
+
+
+def http_protocol() -> str:
+    try:
+        import httptools  # noqa: F401
+        return "httptools"
+    except ImportError:
+        return "h11"
+
+
+def run_gunicorn(workers: int):
+    from gunicorn.app.base import BaseApplication
+    from uvicorn.workers import UvicornWorker
+
+    class Worker(UvicornWorker):
+        CONFIG_KWARGS = {"loop": event_loop(), "http": http_protocol(), "lifespan": "on"}
+
+    class Application(BaseApplication):
+        def load_config(self):
+            settings = {
+                "bind": f"{HOST}:{PORT}",
+                "workers": workers,
+                "worker_class": Worker,
+                "preload_app": True,
+                "graceful_timeout": GRACEFUL_TIMEOUT,
+                "timeout": WORKER_TIMEOUT,
+                "keepalive": KEEPALIVE,
+                "backlog": BACKLOG,
+                "max_requests": MAX_REQUESTS,
+                "max_requests_jitter": MAX_REQUESTS // 10,
+                "loglevel": LOG_LEVEL,
+                "forwarded_allow_ips": FORWARDED_ALLOW_IPS,
+                "accesslog": "-" if LOG_LEVEL == "debug" else None,
+                # Objects created while preloading are never freed, keep the
+                # garbage collector from touching (and un-sharing) their pages
+                "pre_fork": lambda server, worker: gc.freeze(),
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            import main
+            return main.app
+
+    Application().run()
+
+
+def run_uvicorn(workers: int):
+    import uvicorn
+
+    uvicorn.run(
+        APP,
+        host=HOST,
+        port=PORT,
+        workers=workers,
+        loop=event_loop(),
+        http=http_protocol(),
+        backlog=BACKLOG,
+        timeout_keep_alive=KEEPALIVE,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+        limit_max_requests=MAX_REQUESTS or None,
+        log_level=LOG_LEVEL,
+        proxy_headers=True,
+        forwarded_allow_ips=FORWARDED_ALLOW_IPS,
+    )
+
+
+def main():
+    workers = worker_count()
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        print(f"Starting {workers} uvicorn worker(s) ({event_loop()}, {http_protocol()}) on {HOST}:{PORT}")
+        run_uvicorn(workers)
+        return
+    print(f"Starting {workers} preloaded gunicorn worker(s) ({event_loop()}, {http_protocol()}) on {HOST}:{PORT}")
+    run_gunicorn(workers)
+
+
+if __name__ == "__main__":
+    main()